@@ -1,19 +1,33 @@
 # app.py
 import os
-from time import time
+from time import perf_counter
+from datetime import datetime
 import uuid
 import yaml
 import streamlit as st
 from pydantic import ValidationError
 
-from llm import LLM, summarize
-from database import get_conversations, save_message, load_messages_by_conversation_id, save_summary, get_summary, delete_conversation, get_user, get_user_id, save_user, authenticate_user
+from llm import LLM, create_memory, append_messages_to_memory, load_memory_state, save_memory_state, delete_memory_state
+from database import get_conversations_page, save_turns, turn_to_dict_list, load_messages_after, load_recent_messages, load_messages_before, load_messages_between, load_messages_within_budget, search_messages, get_conversation, get_summary, delete_conversation, get_user, init_db
+from summarizer import summarizer
+from streaming import StreamRenderer, stream_concurrently
+from response_cache import response_cache
+from write_behind import write_queue
+from metrics import RERUN_SECONDS, start_metrics_server
+from auth import authenticate, register_user, issue_session_token, verify_session_token, revoke_session_token, LoginRateLimited
 from config import *
 
 
+@RERUN_SECONDS.time()
 def main():
+    # テーブルの作成とマイグレーション（プロセスで一度だけ）
+    init_db()
     # セッションステートの初期化
     initialize_session_state()
+    # 前回コミットされなかった書き込みの再送と、書き込みスレッドの起動
+    write_queue.start()
+    # Prometheus形式のメトリクスを返すHTTPサーバーの起動（プロセスで一度だけ）
+    start_metrics_server()
 
     if st.session_state.logged_in:
         # タイトルの設定
@@ -45,12 +59,16 @@ def main():
         login()
 
 
+@st.cache_data(max_entries=4, show_spinner=False)
+def read_model_config(path, mtime):
+    """models.yamlを読み込む。mtimeをキャッシュのキーに含め、更新されたときだけ読み直す"""
+    with open(path, 'r') as file:
+        return yaml.safe_load(file)
+
 def load_model_config():
     """model.yamlからモデル設定を読み込む"""
     try:
-        with open('models.yaml', 'r') as file:
-            config = yaml.safe_load(file)
-            return config
+        return read_model_config('models.yaml', os.stat('models.yaml').st_mtime_ns)
     except FileNotFoundError:
         st.error("models.yamlファイルが見つかりません。")
         return None
@@ -72,17 +90,119 @@ def handle_new_conversation():
     st.write("新規会話を開始します。メッセージを入力してください。")
     return conversation_id
 
+def load_conversation_cache(conversation_id):
+    """セッションの会話キャッシュを取得し、未取得の新しいメッセージだけを追加する"""
+    caches = st.session_state.conversation_cache
+    cache = caches.get(conversation_id)
+    if cache is None:
+        # 別の会話に切り替えた場合は古いキャッシュを破棄する
+        caches.clear()
+        # 表示用には最新の1ページ分だけを読み込む
+        messages = load_recent_messages(conversation_id, MESSAGE_PAGE_SIZE)
+        memory = load_conversation_memory(conversation_id)
+        cache = {
+            "messages": messages,
+            "last_id": max((message["id"] for message in messages), default=0),
+            "has_older": len(messages) == MESSAGE_PAGE_SIZE,
+            "visible": MESSAGE_PAGE_SIZE,
+            "memory": memory,
+            # まだコミットされていない、このセッションで追加した往復
+            "local_turn_ids": set(),
+        }
+        caches[conversation_id] = cache
+        # 書き込み待ちの往復もすぐに読めるようにする
+        saved_turn_ids = {message["turn_id"] for message in messages}
+        for turn in write_queue.pending_turns(conversation_id):
+            if turn["turn_id"] not in saved_turn_ids:
+                append_local_turn(cache, turn)
+        save_memory_state(conversation_id, memory)
+        return cache
+    new_messages = load_messages_after(conversation_id, cache["last_id"])
+    if new_messages:
+        cache["last_id"] = new_messages[-1]["id"]
+        # このセッションで既に表示済みの往復は表示用のキャッシュには追加しない
+        cache["messages"].extend(message for message in new_messages if message["turn_id"] not in cache["local_turn_ids"])
+        # バックグラウンドで更新されたローリング要約を取り込む
+        conversation = get_conversation(conversation_id)
+        if conversation is not None and (conversation.rolling_summary_until_id or 0) > cache["memory"].summary_until_id:
+            cache["memory"].set_summary(conversation.rolling_summary, conversation.rolling_summary_until_id)
+        # メモリはturn_idで重複を除きつつlast_idを進めるため、保存済みの往復もすべて渡す
+        append_messages_to_memory(cache["memory"], new_messages)
+        trim_conversation_cache(cache)
+        save_memory_state(conversation_id, cache["memory"])
+    return cache
+
+def load_conversation_memory(conversation_id):
+    """会話のメモリを状態の保存先から復元する。ない場合はトークン予算に収まる分のメッセージから作る"""
+    conversation = get_conversation(conversation_id)
+    memory = load_memory_state(conversation_id)
+    if memory is None:
+        memory = create_memory()
+        if conversation is not None:
+            memory.set_summary(conversation.rolling_summary, conversation.rolling_summary_until_id)
+        append_messages_to_memory(memory, load_messages_within_budget(conversation_id, memory.capacity))
+        return memory
+    # 他のプロセスが保存した後に更新されたローリング要約と、追加されたメッセージだけを取り込む
+    if conversation is not None and (conversation.rolling_summary_until_id or 0) > memory.summary_until_id:
+        memory.set_summary(conversation.rolling_summary, conversation.rolling_summary_until_id)
+    append_messages_to_memory(memory, load_messages_after(conversation_id, memory.last_id))
+    return memory
+
+def trim_conversation_cache(cache):
+    """表示件数を一定に保つため、あふれた古いメッセージは捨てる"""
+    overflow = len(cache["messages"]) - cache["visible"]
+    if overflow > 0:
+        del cache["messages"][:overflow]
+        cache["has_older"] = True
+
+def append_local_turn(cache, turn):
+    """保存を待たずに往復を会話キャッシュとメモリに追加する"""
+    messages = turn_to_dict_list(turn)
+    cache["messages"].extend(messages)
+    cache["local_turn_ids"].add(turn["turn_id"])
+    append_messages_to_memory(cache["memory"], messages)
+    trim_conversation_cache(cache)
+
+def load_older_messages(conversation_id, cache):
+    """表示中の最も古いメッセージより前の1ページを読み込む"""
+    if not cache["messages"]:
+        return
+    older_messages = load_messages_before(conversation_id, cache["messages"][0]["cursor"], MESSAGE_PAGE_SIZE)
+    cache["messages"][:0] = older_messages
+    cache["visible"] += len(older_messages)
+    cache["has_older"] = len(older_messages) == MESSAGE_PAGE_SIZE
+
+def load_search_target(conversation_id, cache):
+    """検索結果から開いたメッセージがまだ読み込まれていなければ、そこまでのメッセージを読み込み、そのIDを返す"""
+    target = st.session_state.search_target
+    if target is None or target["conversation_id"] != conversation_id or target["message_id"] is None:
+        return None
+    if cache["messages"] and all(message.get("id") != target["message_id"] for message in cache["messages"]):
+        older_messages = load_messages_between(conversation_id, target["cursor"], cache["messages"][0]["cursor"])
+        cache["messages"][:0] = older_messages
+        cache["visible"] += len(older_messages)
+        cache["has_older"] = True
+    return target["message_id"]
+
 def handle_existing_conversation(conversation_id, llm):
     """既存の会話の処理"""
-    selected_messages = load_messages_by_conversation_id(conversation_id)
-    display_conversation(selected_messages)
-    llm.load_messages_into_memory(selected_messages)
+    cache = load_conversation_cache(conversation_id)
+    highlight_id = load_search_target(conversation_id, cache)
+    if cache["has_older"]:
+        if st.button("過去のメッセージを読み込む", key="load-older"):
+            load_older_messages(conversation_id, cache)
+    selected_messages = cache["messages"]
+    display_conversation(selected_messages, highlight_id)
+    llm.set_memory(cache["memory"])
     return selected_messages
 
-def display_conversation(messages):
-    """会話の表示"""
+def display_conversation(messages, highlight_id=None):
+    """会話の表示（highlight_idのメッセージは検索結果として枠で囲む）"""
     for message in messages:
-        with st.container():
+        highlighted = highlight_id is not None and message.get("id") == highlight_id
+        with st.container(border=highlighted):
+            if highlighted:
+                st.caption("🔍 検索結果")
             with st.chat_message(message['sender']):
                 st.write(f"{message['message']}")
                 if message["caption"]:
@@ -90,33 +210,125 @@ def display_conversation(messages):
 
 def process_user_input(user_input, llm):
     """ユーザー入力の処理とLLMの応答取得"""
-    start_time = time()
+    start_time = perf_counter()
     with st.chat_message(USER_NAME):
         st.write(user_input)
     with st.chat_message(ASSISTANT_NAME):
-        assistant_msg = ""
-        assistant_response_area = st.empty()
-        for chunk in llm.stream(user_input):
-            assistant_msg += chunk.content
-            assistant_response_area.write(assistant_msg + "▌")
-        assistant_response_area.write(assistant_msg)
-        end_time = time()
-        # caption = f"Time: {end_time - start_time:.2f}s, Model: {llm.model_name}, Memory: {llm.load_memory()}"
-        caption = f"Time: {end_time - start_time:.2f}s, Model: {llm.model_name}"
+        renderer = StreamRenderer(st.empty(), start_time=start_time)
+        # 同じモデルへのリクエストが混んでいる場合は、順番待ちの位置を表示する
+        on_queue = lambda position: renderer.area.caption(f"⏳ 順番待ち中（{position}番目）…")
+        assistant_msg = renderer.consume(llm.stream(user_input, on_queue=on_queue))
+        caption = renderer.caption(llm.model_name, cached=llm.last_cache_hit)
         st.caption(caption)
-    return assistant_msg, caption
+    return assistant_msg, caption, renderer.stats(cached=llm.last_cache_hit)
 
-def save_messages(user_input, assistant_msg, caption, conversation_id):
-    """メッセージの保存と表示"""
+def persist_turn(conversation_id, user_input, assistant_messages):
+    """往復を保存し、保存の完了を待たずに会話キャッシュへ反映する"""
     user_id = st.session_state.user_id
-    save_message("User", user_input, "", conversation_id, user_id)
-    save_message("Assistant", assistant_msg, caption, conversation_id, user_id)
+    if WRITE_BEHIND_ENABLED:
+        turn = write_queue.submit(conversation_id, user_id, user_input, assistant_messages)
+    else:
+        turn = {
+            "turn_id": uuid.uuid4().hex,
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "user_message": user_input,
+            "assistant_messages": assistant_messages,
+            "timestamp": None,
+        }
+        save_turns([turn])
+    cache = st.session_state.conversation_cache.get(conversation_id)
+    if cache is not None:
+        append_local_turn(cache, turn)
+        save_memory_state(conversation_id, cache["memory"])
+
+def save_messages(user_input, assistant_msg, caption, conversation_id, stats=None):
+    """メッセージの保存と表示"""
+    persist_turn(conversation_id, user_input, [{"message": assistant_msg, "caption": caption, **(stats or {})}])
+
+def has_api_key(provider):
+    """プロバイダのAPIキーが入力されているかを判定する"""
+    if provider == "OpenAI":
+        return bool(st.session_state.openai_api_key)
+    if provider == "Anthropic":
+        return bool(st.session_state.anthropic_api_key)
+    return False
+
+def create_compare_llms(memory):
+    """比較モードで選択されたモデルのLLMを、同じ会話メモリを共有して生成する"""
+    llms = []
+    for option in st.session_state.get("compare_models", []):
+        provider, model_name = option.split("/", 1)
+        if not has_api_key(provider):
+            st.warning(f"{provider}のAPIキーが設定されていないため、{model_name}は比較から除外します。")
+            continue
+        llms.append(LLM(
+            model_provider=provider,
+            model_name=model_name,
+            system_message=SYSTEM,
+            openai_api_key=st.session_state.openai_api_key,
+            anthropic_api_key=st.session_state.anthropic_api_key,
+            memory=memory,
+        ))
+    return llms
+
+def process_compare_input(user_input, llms):
+    """複数モデルに同じ入力を並行して送り、応答を列ごとにストリーミング表示する"""
+    start_time = perf_counter()
+    with st.chat_message(USER_NAME):
+        st.write(user_input)
+    with st.chat_message(ASSISTANT_NAME):
+        columns = st.columns(len(llms))
+        renderers = []
+        for column, llm in zip(columns, llms):
+            with column:
+                st.markdown(f"**{llm.model_name}**")
+                renderers.append(StreamRenderer(st.empty(), start_time=start_time))
+
+        errors = {}
+        for index, content, error in stream_concurrently(llms, user_input):
+            if content is not None:
+                renderers[index].write(content)
+                continue
+            renderers[index].close()
+            if error is not None:
+                errors[index] = error
+
+        responses = []
+        for index, (column, llm, renderer) in enumerate(zip(columns, llms, renderers)):
+            with column:
+                if index in errors:
+                    st.error(f"{llm.model_name}の応答に失敗しました: {errors[index]}")
+                    continue
+                caption = renderer.caption(llm.model_name, cached=llm.last_cache_hit)
+                st.caption(caption)
+                responses.append((renderer.buffer.getvalue(), caption, renderer.stats(cached=llm.last_cache_hit)))
+    return responses
+
+def save_compare_messages(user_input, responses, conversation_id):
+    """比較モードのユーザー入力と各モデルの応答を保存する"""
+    persist_turn(conversation_id, user_input, [
+        {"message": assistant_msg, "caption": caption, **stats}
+        for assistant_msg, caption, stats in responses
+    ])
 
 def initialize_session_state():
     if 'chat_log' not in st.session_state:
         st.session_state.chat_log = []
     if 'selected_conversation_id' not in st.session_state:
         st.session_state.selected_conversation_id = 'default'
+    if 'conversation_cache' not in st.session_state:
+        st.session_state.conversation_cache = {}
+    if 'history_cursors' not in st.session_state:
+        st.session_state.history_cursors = [None]
+    if 'history_filters' not in st.session_state:
+        st.session_state.history_filters = None
+    if 'search_terms' not in st.session_state:
+        st.session_state.search_terms = None
+    if 'search_page' not in st.session_state:
+        st.session_state.search_page = 0
+    if 'search_target' not in st.session_state:
+        st.session_state.search_target = None
     if 'logged_in' not in st.session_state:
         st.session_state.logged_in = False
     if 'openai_api_key' not in st.session_state:
@@ -127,30 +339,61 @@ def initialize_session_state():
         st.session_state.provider = PROVIDER
     if 'model' not in st.session_state:
         st.session_state.model = MODEL
+    if not st.session_state.logged_in:
+        restore_session()
+
+def restore_session():
+    """URLのセッショントークンが有効であれば、パスワードを照合せずにログイン状態を復元する"""
+    token = st.query_params.get("session")
+    if not token:
+        return
+    verified = verify_session_token(token)
+    if verified is None:
+        del st.query_params["session"]
+        return
+    st.session_state.user_id, st.session_state.username = verified
+    st.session_state.logged_in = True
+    # URLは履歴や共有で漏れうるため、使ったトークンは無効にして新しいトークンに入れ替える
+    revoke_session_token(token)
+    st.query_params["session"] = issue_session_token(*verified)
 
 def login():
     st.title("ログイン")
     username = st.text_input("ユーザー名")
     password = st.text_input("パスワード", type="password")
     if st.button("ログイン"):
-        if authenticate_user(username, password):
+        user = None
+        try:
+            user = authenticate(username, password)
+            if user is None:
+                st.error("ユーザー名またはパスワードが間違っています")
+        except LoginRateLimited as error:
+            st.error(f"ログインの失敗が続いたため、一時的にログインできません。{error}")
+        if user is not None:
             st.session_state.logged_in = True
-            st.session_state.username = username
-            st.session_state.user_id = get_user_id(username)
+            st.session_state.username = user.username
+            st.session_state.user_id = user.id
+            # 再接続時にパスワードの照合を省けるよう、署名付きトークンをURLに保存する
+            st.query_params["session"] = issue_session_token(user.id, user.username)
             st.success("ログインに成功しました")
             st.rerun()
-        else:
-            st.error("ユーザー名またはパスワードが間違っています")
     with st.expander("新規登録"):
         register()
 
 def logout():
     if st.button("Logout"):
+        if "session" in st.query_params:
+            # 他のプロセスでもこのトークンで復元できないよう、セッションを無効にする
+            revoke_session_token(st.query_params["session"])
+            del st.query_params["session"]
         st.session_state.logged_in = False
         st.session_state.username = None
         st.session_state.user_id = None
         st.session_state.chat_log = []
         st.session_state.selected_conversation_id = 'default'
+        st.session_state.conversation_cache = {}
+        st.session_state.history_cursors = [None]
+        st.session_state.history_filters = None
         st.session_state.openai_api_key = ""
         st.session_state.anthropic_api_key = ""
         st.session_state.provider = PROVIDER
@@ -165,7 +408,7 @@ def register():
         if get_user(username):
             st.error("このユーザー名は既に使用されています")
         else:
-            save_user(username, password)
+            register_user(username, password)
             st.success("ユーザー登録に成功しました。ログインしてください。")
 
 
@@ -179,6 +422,8 @@ def setup_sidebar():
     with st.sidebar:
         if st.button("New Chat", key="new"):
             st.session_state.selected_conversation_id = str(uuid.uuid4())
+            st.session_state.search_target = None
+        display_search()
         display_conversation_history()
         
         # APIキーの入力フィールド
@@ -202,25 +447,110 @@ def setup_sidebar():
         
         model = st.sidebar.selectbox("Model", models[provider])
         st.session_state.model = model
+
+        # 比較モード：同じ入力を複数のモデルに並行して送る
+        if st.sidebar.toggle("Compare", key="compare_mode"):
+            compare_options = [f"{provider}/{model}" for provider in providers for model in models[provider]]
+            st.sidebar.multiselect("比較するモデル", compare_options, key="compare_models")
+
+        if RESPONSE_CACHE_ENABLED:
+            cache_stats = response_cache.stats()
+            st.sidebar.caption(f"Cache: {cache_stats['hits'] + cache_stats['near_hits']} hits / {cache_stats['misses']} misses")
         
         logout()
 
+def get_history_filters():
+    """履歴の絞り込み条件を入力し、(開始日時, 終了日時, 前方一致文字列) を返す"""
+    prefix = st.text_input("タイトルで絞り込み", key="history_prefix")
+    date_range = st.date_input("期間", value=(), key="history_dates")
+    date_from = date_to = None
+    if len(date_range) >= 1:
+        date_from = datetime.combine(date_range[0], datetime.min.time())
+    if len(date_range) == 2:
+        date_to = datetime.combine(date_range[1], datetime.max.time())
+    return date_from, date_to, prefix.strip()
+
+def display_search():
+    """メッセージ本文と要約を全文検索し、結果から会話の該当メッセージを開く"""
+    with st.expander("Search"):
+        query = st.text_input("メッセージを検索", key="search_query").strip()
+        if not query:
+            return
+        # 検索語が変わったら1ページ目に戻る
+        if st.session_state.search_terms != query:
+            st.session_state.search_terms = query
+            st.session_state.search_page = 0
+        page = st.session_state.search_page
+
+        results, has_next = search_messages(st.session_state.user_id, query, SEARCH_PAGE_SIZE, page * SEARCH_PAGE_SIZE)
+        if not results:
+            st.write("一致するメッセージがありません。")
+        for index, result in enumerate(results):
+            with st.container(border=True):
+                title = result["title"] or "（要約なし）"
+                st.caption(f"{result['timestamp'].strftime('%Y-%m-%d %H:%M')} {title}")
+                st.markdown(result["snippet"])
+                if st.button("開く", key=f"search-{page}-{index}"):
+                    st.session_state.selected_conversation_id = result["conversation_id"]
+                    st.session_state.search_target = result
+
+        # ページ送り
+        prev_col, next_col = st.columns(2)
+        with prev_col:
+            if page > 0 and st.button("前へ", key="search-prev"):
+                st.session_state.search_page -= 1
+                st.rerun()
+        with next_col:
+            if has_next and st.button("次へ", key="search-next"):
+                st.session_state.search_page += 1
+                st.rerun()
+
 def display_conversation_history():
     with st.expander("History"):
         user_id = st.session_state.user_id
-        for conversation_id, timestamp in sorted(get_conversations(user_id), key=lambda x: x[1], reverse=True):
-            formatted_timestamp = timestamp.strftime("%Y-%m-%d %H:%M:%S")
+        date_from, date_to, prefix = get_history_filters()
+
+        # 絞り込み条件が変わったら1ページ目に戻る
+        filters = (date_from, date_to, prefix)
+        if st.session_state.history_filters != filters:
+            st.session_state.history_filters = filters
+            st.session_state.history_cursors = [None]
+        cursor = st.session_state.history_cursors[-1]
+
+        conversations, next_cursor = get_conversations_page(
+            user_id, HISTORY_PAGE_SIZE, cursor=cursor, date_from=date_from, date_to=date_to, prefix=prefix
+        )
+        if not conversations:
+            st.write("会話がありません。")
+        for conversation in conversations:
+            conversation_id = conversation["id"]
+            formatted_timestamp = conversation["updated_at"].strftime("%Y-%m-%d %H:%M:%S")
             with st.container(border=True):
                 st.subheader(formatted_timestamp, divider="rainbow")
-                # summary = get_summary(conversation_id) or "No summary available"
-                # st.write(summary)
+                # 要約は計算済みのものだけを表示する
+                if conversation["summary"]:
+                    st.write(conversation["summary"])
                 if st.button("Load Chat", key=f"load-{conversation_id}"):
                     st.session_state.selected_conversation_id = conversation_id
+                    st.session_state.search_target = None
 
                 if st.button("Delete Chat", key=f"delete-{conversation_id}"):
                     delete_conversation(conversation_id)
+                    st.session_state.conversation_cache.pop(conversation_id, None)
+                    delete_memory_state(conversation_id)
                     st.rerun()
 
+        # ページ送り
+        prev_col, next_col = st.columns(2)
+        with prev_col:
+            if len(st.session_state.history_cursors) > 1 and st.button("前へ", key="history-prev"):
+                st.session_state.history_cursors.pop()
+                st.rerun()
+        with next_col:
+            if next_cursor is not None and st.button("次へ", key="history-next"):
+                st.session_state.history_cursors.append(next_cursor)
+                st.rerun()
+
 def process_conversation(conversation_id, llm):
     selected_messages = []
     if conversation_id == "new":
@@ -231,18 +561,21 @@ def process_conversation(conversation_id, llm):
 
 def user_interaction(conversation_id, llm):
     if user_msg := st.chat_input("ここにメッセージを入力"):
-        assistant_msg, caption = process_user_input(user_msg, llm)
-        save_messages(user_msg, assistant_msg, caption, conversation_id)
-        # 要約とその保存
-        # summarize_and_save(conversation_id, llm)
-
-def summarize_and_save(conversation_id, llm):
-    """会話内容から要約を生成し、保存"""
-    selected_messages = load_messages_by_conversation_id(conversation_id)
-    llm.load_messages_into_memory(selected_messages)
-    saved_summary = summarize(llm.load_memory())
-    save_summary(saved_summary, conversation_id)
-    st.rerun()
+        compare_llms = create_compare_llms(llm.state["memory"]) if st.session_state.get("compare_mode") else []
+        if compare_llms:
+            responses = process_compare_input(user_msg, compare_llms)
+            save_compare_messages(user_msg, responses, conversation_id)
+        else:
+            assistant_msg, caption, stats = process_user_input(user_msg, llm)
+            save_messages(user_msg, assistant_msg, caption, conversation_id, stats)
+        # 要約とその保存（バックグラウンドで実行する）
+        summarize_and_save(conversation_id)
+
+def summarize_and_save(conversation_id):
+    """会話内容の要約ジョブをバックグラウンドの要約サービスに登録する"""
+    provider = st.session_state.provider
+    api_key = st.session_state.openai_api_key if provider == "OpenAI" else st.session_state.anthropic_api_key
+    summarizer.submit(conversation_id, provider, api_key)
 
 
 if __name__ == "__main__":
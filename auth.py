@@ -0,0 +1,150 @@
+# auth.py
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from time import time
+
+from metrics import BCRYPT_SECONDS
+from state_store import state_store
+from database import get_user, check_password, hash_password, save_user_with_hash
+from config import SESSION_SECRET, SESSION_TOKEN_TTL, LOGIN_MAX_FAILURES, LOGIN_FAILURE_WINDOW, BCRYPT_MAX_WORKERS
+
+# bcryptはCPUを使うため、コア数までの専用スレッドで実行する
+_bcrypt_pool = ThreadPoolExecutor(max_workers=BCRYPT_MAX_WORKERS, thread_name_prefix="bcrypt")
+
+@lru_cache(maxsize=1)
+def _dummy_hash():
+    # 存在しないユーザーでも同じだけ時間がかかるよう、照合に使うダミーのハッシュ
+    return hash_password(secrets.token_hex(16))
+
+
+@lru_cache(maxsize=1)
+def _secret():
+    # SESSION_SECRETが未設定の場合は、状態の保存先で最初に作られた鍵を全プロセスで共有する
+    return (SESSION_SECRET or state_store.add("auth:session_secret", secrets.token_hex(32))).encode("utf-8")
+
+
+class LoginRateLimiter:
+    """ユーザー名ごとにログインの失敗回数を数え、一定時間内の失敗が多い場合は試行を拒否する
+
+    失敗した時刻は状態の保存先に置き、複数のプロセスで同じ上限を共有する。
+    """
+
+    def __init__(self, max_failures=LOGIN_MAX_FAILURES, window=LOGIN_FAILURE_WINDOW, store=state_store):
+        self.max_failures = max_failures
+        self.window = window
+        self.store = store
+        self._lock = threading.Lock()
+
+    def _failures(self, username, now):
+        # 期間内の失敗の時刻を古い順に返す
+        failures = self.store.get(f"login_failures:{username}") or []
+        return [failed_at for failed_at in failures if now - failed_at <= self.window]
+
+    def retry_after(self, username):
+        """試行を拒否する場合は再試行できるまでの秒数を、そうでなければ0を返す"""
+        now = time()
+        failures = self._failures(username, now)
+        if len(failures) < self.max_failures:
+            return 0
+        return self.window - (now - failures[-self.max_failures])
+
+    def record_failure(self, username):
+        # 保存先に原子的な追加がないため、別のプロセスと同時に失敗した場合は1回分を数え損ねることがある
+        now = time()
+        with self._lock:
+            failures = self._failures(username, now) + [now]
+            # 判定に使うのは直近のmax_failures回分だけ
+            self.store.set(f"login_failures:{username}", failures[-self.max_failures:], ttl=self.window)
+
+    def reset(self, username):
+        self.store.delete(f"login_failures:{username}")
+
+
+rate_limiter = LoginRateLimiter()
+
+
+class LoginRateLimited(Exception):
+    """ログインの失敗が続いたため、一時的に試行できない"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"{retry_after:.0f}秒後に再試行してください")
+        self.retry_after = retry_after
+
+
+def authenticate(username, password):
+    """ユーザー名とパスワードを照合し、成功すればユーザーを返す。失敗した場合はNoneを返す"""
+    retry_after = rate_limiter.retry_after(username)
+    if retry_after > 0:
+        raise LoginRateLimited(retry_after)
+    user = get_user(username)
+    hashed_password = user.password if user else _dummy_hash()
+    with BCRYPT_SECONDS.time(operation="check"):
+        matched = _bcrypt_pool.submit(check_password, hashed_password, password).result()
+    if user and matched:
+        rate_limiter.reset(username)
+        return user
+    rate_limiter.record_failure(username)
+    return None
+
+
+def register_user(username, password):
+    """パスワードをワーカーでハッシュ化してユーザーを登録する"""
+    with BCRYPT_SECONDS.time(operation="hash"):
+        hashed_password = _bcrypt_pool.submit(hash_password, password).result()
+    save_user_with_hash(username, hashed_password)
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload):
+    return _b64encode(hmac.new(_secret(), payload.encode("ascii"), hashlib.sha256).digest())
+
+
+def issue_session_token(user_id, username, ttl=SESSION_TOKEN_TTL):
+    """ログイン済みのユーザーを表す署名付きの期限付きトークンを発行する
+
+    セッションは状態の保存先にも登録し、ログアウトしたときにどのプロセスでも無効になるようにする。
+    """
+    session_id = secrets.token_urlsafe(16)
+    state_store.set(f"session:{session_id}", {"uid": user_id, "usr": username}, ttl=ttl)
+    payload = _b64encode(json.dumps({"sid": session_id, "uid": user_id, "usr": username, "exp": int(time() + ttl)}).encode("utf-8"))
+    return f"{payload}.{_sign(payload)}"
+
+
+def _verified_claims(token):
+    try:
+        payload, signature = token.split(".", 1)
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        return json.loads(_b64decode(payload))
+    except (ValueError, UnicodeError):
+        return None
+
+
+def verify_session_token(token):
+    """トークンを検証し、有効であれば (ユーザーID, ユーザー名) を返す。無効な場合はNoneを返す"""
+    claims = _verified_claims(token)
+    if claims is None or claims.get("exp", 0) < time():
+        return None
+    if "sid" not in claims or state_store.get(f"session:{claims['sid']}") is None:
+        return None
+    return claims["uid"], claims["usr"]
+
+
+def revoke_session_token(token):
+    """トークンのセッションを無効にする"""
+    claims = _verified_claims(token)
+    if claims is not None and "sid" in claims:
+        state_store.delete(f"session:{claims['sid']}")
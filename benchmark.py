@@ -0,0 +1,374 @@
+# benchmark.py
+"""オフラインのベンチマーク
+
+APIを呼ばないフェイクのチャットモデルと、seedから生成したSQLiteのデータセットを使って
+DBの読み込み、メモリへのロード、会話の描画、main()の再実行、チャットの往復の時間を計測し、
+パーセンタイルをJSONで出力する。
+
+    python benchmark.py --users 10000 --messages 5000000 --output result.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import uuid
+from datetime import datetime, timedelta
+from time import perf_counter
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+PERCENTILES = (50, 90, 95, 99)
+FAKE_MODEL = "fake-model"
+# データセットの内容を変えたら上げる（既存のデータセットを作り直させる）
+DATASET_VERSION = 2
+
+DISPLAY_SCRIPT = """
+import streamlit as st
+from app import display_conversation
+
+display_conversation(st.session_state.benchmark_messages)
+"""
+
+_WORDS = ["今日", "明日", "データベース", "モデル", "プロンプト", "会話", "要約", "検索", "設定", "速度",
+          "python", "streamlit", "sqlite", "query", "index", "cache", "token", "stream", "latency", "memory"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="フェイクのモデルとseed付きのデータセットでアプリの処理時間を計測する")
+    parser.add_argument("--workdir", default="benchmark_data", help="データセットと作業ファイルの置き場所")
+    parser.add_argument("--users", type=int, default=100, help="データセットのユーザー数")
+    parser.add_argument("--messages", type=int, default=20000, help="データセットのメッセージ数")
+    parser.add_argument("--messages-per-conversation", type=int, default=20, help="1会話あたりのメッセージ数")
+    parser.add_argument("--seed", type=int, default=0, help="データセットと計測対象の選択に使うseed")
+    parser.add_argument("--regenerate", action="store_true", help="既存のデータセットを作り直す")
+    parser.add_argument("--iterations", type=int, default=30, help="各ベンチマークの計測回数")
+    parser.add_argument("--warmup", type=int, default=3, help="計測前に捨てる実行回数")
+    parser.add_argument("--ttft", type=float, default=0.05, help="フェイクモデルの最初のトークンまでの秒数")
+    parser.add_argument("--tokens-per-sec", type=float, default=500.0, help="フェイクモデルのトークン生成速度")
+    parser.add_argument("--response-tokens", type=int, default=64, help="フェイクモデルの応答のトークン数")
+    parser.add_argument("--only", nargs="*", help="実行するベンチマーク名（省略時はすべて）")
+    parser.add_argument("--output", help="結果のJSONの出力先（省略時は標準出力）")
+    return parser.parse_args()
+
+
+def dataset_params(args):
+    return {
+        "version": DATASET_VERSION,
+        "users": args.users,
+        "messages": args.messages,
+        "messages_per_conversation": args.messages_per_conversation,
+        "seed": args.seed,
+    }
+
+
+def prepare_workdir(args):
+    """作業ディレクトリに移動し、データセットの再生成が必要かどうかを返す
+
+    アプリのモジュールはインポート時にDATABASE_URLや相対パスのファイルを参照するため、
+    インポートより前に呼ぶ。
+    """
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)
+    db_path = os.path.abspath("benchmark.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    params_path = db_path + ".json"
+    params = dataset_params(args)
+    stale = args.regenerate or not os.path.exists(db_path)
+    if not stale:
+        try:
+            with open(params_path, encoding="utf-8") as file:
+                stale = json.load(file) != params
+        except (OSError, json.JSONDecodeError):
+            stale = True
+    if stale:
+        for suffix in ("", "-wal", "-shm", ".json"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+    # サイドバーは2番目のプロバイダを既定で選ぶため、フェイクのプロバイダを2番目に置く
+    with open("models.yaml", "w", encoding="utf-8") as file:
+        file.write(f"OpenAI:\n  - gpt-4o-mini\nFake:\n  - {FAKE_MODEL}\n")
+    return db_path, params_path, stale
+
+
+def _text(rng, min_words, max_words):
+    return " ".join(rng.choice(_WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def _fake_stats(rng, output_tokens):
+    return {"ttft": rng.uniform(0.2, 1.5), "output_tokens": output_tokens, "tokens_per_sec": rng.uniform(20.0, 80.0)}
+
+
+def _caption(stats):
+    # StreamRenderer.caption() と同じ形式
+    elapsed = stats["ttft"] + stats["output_tokens"] / stats["tokens_per_sec"]
+    return (f"Time: {elapsed:.2f}s, TTFT: {stats['ttft']:.2f}s, Tokens: {stats['output_tokens']}, "
+            f"{stats['tokens_per_sec']:.1f} tokens/s, Model: {FAKE_MODEL}")
+
+
+def generate_dataset(args, params_path, batch_size=20000):
+    """seedから決まるユーザー・会話・メッセージを一括で挿入する"""
+    from sqlalchemy import insert
+    from database import engine, Message, Conversation, User, hash_password, JST
+    from tokenizer import estimate_tokens
+
+    rng = random.Random(args.seed)
+    # bcryptは遅いため、全ユーザーで同じハッシュを使う
+    password = hash_password("password").decode("utf-8")
+    with engine.begin() as connection:
+        connection.execute(insert(User.__table__), [
+            {"id": i, "username": f"user{i:05d}", "password": password} for i in range(1, args.users + 1)
+        ])
+
+    per_conversation = max(2, args.messages_per_conversation)
+    conversation_count = max(1, args.messages // per_conversation)
+    base = datetime(2024, 1, 1, tzinfo=JST)
+    messages, conversations = [], []
+
+    def flush():
+        with engine.begin() as connection:
+            if messages:
+                connection.execute(insert(Message.__table__), messages)
+            if conversations:
+                connection.execute(insert(Conversation.__table__), conversations)
+        messages.clear()
+        conversations.clear()
+
+    for _ in range(conversation_count):
+        conversation_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        user_id = str(rng.randint(1, args.users))
+        created_at = base + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+        timestamp = created_at
+        for index in range(per_conversation):
+            stats = {"ttft": None, "output_tokens": None, "tokens_per_sec": None}
+            if index % 2 == 0:
+                turn_id = uuid.UUID(int=rng.getrandbits(128), version=4).hex
+                # アプリと同じ送信者名・キャプションで保存する（ユーザーのメッセージのキャプションは空文字）
+                sender, body, caption = "User", _text(rng, 3, 30), ""
+            else:
+                sender, body = "Assistant", _text(rng, 20, 200)
+                stats = _fake_stats(rng, estimate_tokens(body))
+                caption = _caption(stats)
+            messages.append({
+                "conversation_id": conversation_id,
+                "user_id": user_id,
+                "sender": sender,
+                "message": body,
+                "caption": caption,
+                "timestamp": timestamp,
+                "token_count": estimate_tokens(body),
+                "turn_id": turn_id,
+                **stats,
+            })
+            timestamp += timedelta(seconds=rng.randint(5, 300))
+        conversations.append({
+            "id": conversation_id,
+            "user_id": user_id,
+            "created_at": created_at,
+            "updated_at": timestamp,
+            "message_count": per_conversation,
+            "summary": _text(rng, 1, 3),
+            "summarized_count": per_conversation,
+        })
+        if len(messages) >= batch_size:
+            flush()
+    flush()
+    with open(params_path, "w", encoding="utf-8") as file:
+        json.dump(dataset_params(args), file)
+
+
+def sample_conversations(args):
+    """計測に使う会話を、seedから決まる順序で選ぶ"""
+    from database import session_scope, Conversation
+
+    with session_scope() as session:
+        rows = session.query(Conversation.id, Conversation.user_id).order_by(Conversation.id).all()
+    rng = random.Random(args.seed + 1)
+    count = args.iterations + args.warmup
+    return [rows[rng.randrange(len(rows))] for _ in range(count)]
+
+
+def measure(func, samples, warmup):
+    """samplesの各要素でfuncを呼び、warmup回目以降の所要時間（秒）を返す"""
+    timings = []
+    for index, sample in enumerate(samples):
+        start = perf_counter()
+        func(sample)
+        elapsed = perf_counter() - start
+        if index >= warmup:
+            timings.append(elapsed)
+    return timings
+
+
+def summarize_timings(timings):
+    import numpy as np
+
+    values = np.array(timings) * 1000
+    result = {"n": len(timings), "mean_ms": float(values.mean()), "min_ms": float(values.min()), "max_ms": float(values.max())}
+    for percentile in PERCENTILES:
+        result[f"p{percentile}_ms"] = float(np.percentile(values, percentile))
+    return result
+
+
+def new_app_test(conversation_id, user_id):
+    """ログイン済みのセッションで会話を選択した状態のAppTestを作る"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=600)
+    at.session_state.logged_in = True
+    at.session_state.user_id = int(user_id)
+    at.session_state.username = f"user{int(user_id):05d}"
+    at.session_state.selected_conversation_id = conversation_id
+    return at
+
+
+def _check(at):
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+
+
+def bench_get_conversations(samples, args):
+    from database import get_conversations
+
+    return measure(lambda sample: get_conversations(sample[1]), samples, args.warmup)
+
+
+def bench_load_messages(samples, args):
+    from database import load_messages_by_conversation_id
+
+    return measure(lambda sample: load_messages_by_conversation_id(sample[0]), samples, args.warmup)
+
+
+def bench_load_messages_into_memory(samples, args):
+    from database import load_messages_by_conversation_id
+    from llm import LLM
+    from fake_llm import FAKE_PROVIDER
+
+    llm = LLM(model_provider=FAKE_PROVIDER, model_name=FAKE_MODEL)
+    loaded = {sample[0]: load_messages_by_conversation_id(sample[0]) for sample in samples}
+    return measure(lambda sample: llm.load_messages_into_memory(loaded[sample[0]]), samples, args.warmup)
+
+
+def bench_display_conversation(samples, args):
+    from streamlit.testing.v1 import AppTest
+    from database import load_messages_by_conversation_id
+
+    def run(sample):
+        at = AppTest.from_string(DISPLAY_SCRIPT, default_timeout=600)
+        at.session_state.benchmark_messages = loaded[sample[0]]
+        at.run()
+        _check(at)
+
+    loaded = {sample[0]: load_messages_by_conversation_id(sample[0]) for sample in samples}
+    return measure(run, samples, args.warmup)
+
+
+def bench_main_rerun(samples, args):
+    """会話キャッシュが空の初回実行（cold）と、2回目以降の再実行（warm）を計測する"""
+    cold, warm = [], []
+    for index, (conversation_id, user_id) in enumerate(samples):
+        at = new_app_test(conversation_id, user_id)
+        start = perf_counter()
+        at.run()
+        middle = perf_counter()
+        at.run()
+        end = perf_counter()
+        _check(at)
+        if index >= args.warmup:
+            cold.append(middle - start)
+            warm.append(end - middle)
+    return {"main_rerun_cold": cold, "main_rerun_warm": warm}
+
+
+def bench_chat_turn(samples, args):
+    """新規会話で1往復したときの所要時間と、フェイクモデルの生成時間を除いたオーバーヘッドを計測する"""
+    from database import delete_conversation
+    from write_behind import write_queue
+
+    model_time = args.ttft + max(0, args.response_tokens - 1) / args.tokens_per_sec
+    turns, overheads, created = [], [], []
+    try:
+        for index, (_, user_id) in enumerate(samples):
+            conversation_id = str(uuid.uuid4())
+            created.append(conversation_id)
+            at = new_app_test(conversation_id, user_id)
+            at.run()
+            # キャッシュに当たらないよう、入力は毎回変える
+            at.chat_input[0].set_value(f"ベンチマークの質問 {index} {conversation_id}")
+            start = perf_counter()
+            at.run()
+            elapsed = perf_counter() - start
+            _check(at)
+            if index >= args.warmup:
+                turns.append(elapsed)
+                overheads.append(elapsed - model_time)
+    finally:
+        # データセットを次回の実行と同じ状態に保つため、作成した会話を削除する
+        write_queue.flush()
+        for conversation_id in created:
+            delete_conversation(conversation_id, soft=False)
+    return {"chat_turn": turns, "chat_turn_overhead": overheads}
+
+
+BENCHMARKS = {
+    "get_conversations": bench_get_conversations,
+    "load_messages_by_conversation_id": bench_load_messages,
+    "load_messages_into_memory": bench_load_messages_into_memory,
+    "display_conversation": bench_display_conversation,
+    "main_rerun": bench_main_rerun,
+    "chat_turn": bench_chat_turn,
+}
+
+
+def main():
+    args = parse_args()
+    # 作業ディレクトリに移動する前に、出力先を呼び出し時のディレクトリからの絶対パスにしておく
+    output_path = os.path.abspath(args.output) if args.output else None
+    db_path, params_path, stale = prepare_workdir(args)
+
+    from database import init_db
+    from fake_llm import register_fake_provider
+
+    init_db()
+    generate_seconds = None
+    if stale:
+        start = perf_counter()
+        generate_dataset(args, params_path)
+        generate_seconds = perf_counter() - start
+    register_fake_provider(ttft=args.ttft, tokens_per_sec=args.tokens_per_sec,
+                           response_tokens=args.response_tokens, seed=args.seed)
+    samples = sample_conversations(args)
+
+    results = {}
+    for name, bench in BENCHMARKS.items():
+        if args.only and name not in args.only:
+            continue
+        timings = bench(samples, args)
+        if isinstance(timings, dict):
+            results.update({key: summarize_timings(values) for key, values in timings.items()})
+        else:
+            results[name] = summarize_timings(timings)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+        },
+        "dataset": {**dataset_params(args), "path": db_path, "generated_seconds": generate_seconds},
+        "model": {"ttft": args.ttft, "tokens_per_sec": args.tokens_per_sec, "response_tokens": args.response_tokens},
+        "iterations": args.iterations,
+        "warmup": args.warmup,
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,4 +9,97 @@ ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
 PROVIDER = "Anthropic"
 MODEL = "claude-3-haiku-20240307"
 MAX_TOKENS = 2048
-SYSTEM = "必ず日本語で返答してください。"
\ No newline at end of file
+# SQLAlchemyの接続URL（PostgreSQLなども指定できる）
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///chat_history.db")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = 30
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_CACHE_SIZE_KB = 64 * 1024
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+# Trueの場合、会話の削除は論理削除にして保持期間のジョブで物理削除する
+SOFT_DELETE = False
+# 保持期間（日）と、アーカイブの出力先
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", 365))
+RETENTION_ARCHIVE_DIR = os.environ.get("RETENTION_ARCHIVE_DIR", "archive")
+RETENTION_BATCH_SIZE = 500
+RETENTION_VACUUM_PAGES = 1000
+SYSTEM = "必ず日本語で返答してください。"
+# ログイン済みセッションのトークンに署名する鍵（複数プロセスで共有する場合は環境変数で指定する）
+SESSION_SECRET = os.environ.get("SESSION_SECRET")
+# トークンはURLに含まれるため短めにし、復元するたびに新しいトークンに入れ替える
+SESSION_TOKEN_TTL = 60 * 60 * 12
+LOGIN_MAX_FAILURES = 5
+LOGIN_FAILURE_WINDOW = 300
+BCRYPT_MAX_WORKERS = os.cpu_count() or 1
+CLIENT_POOL_MAX_SIZE = 16
+CLIENT_IDLE_TIMEOUT = 600
+MESSAGE_PAGE_SIZE = 50
+HISTORY_PAGE_SIZE = 10
+SUMMARY_MAX_WORKERS = 2
+SUMMARY_MIN_NEW_MESSAGES = 6
+SUMMARY_BATCH_SIZE = 8
+SUMMARY_BATCH_INTERVAL = 2.0
+SUMMARY_CONTEXT_MESSAGES = 20
+# 要約に使うプロバイダごとのモデル（会話で使っているプロバイダのものを使う）
+SUMMARY_MODELS = {
+    "OpenAI": "gpt-4o-mini",
+    "Anthropic": "claude-3-haiku-20240307",
+}
+# ローリング要約の上限トークン数（最も小さいモデルの予算からこれを引いた分を超えたメッセージを要約し、要約はこれに切り詰める）
+ROLLING_SUMMARY_MAX_TOKENS = 512
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_URL = "sqlite:///response_cache.db"
+RESPONSE_CACHE_TTL = 60 * 60 * 24
+RESPONSE_CACHE_MAX_ENTRIES = 10000
+RESPONSE_CACHE_NEAR_DUPLICATE = False
+RESPONSE_CACHE_SIMILARITY = 0.92
+RESPONSE_CACHE_CANDIDATES = 200
+# 会話メモリのトークン予算（モデルごとに上書きできる）
+MEMORY_TOKEN_BUDGET = MAX_TOKENS
+MODEL_MEMORY_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo": 1024,
+    "gpt-4o": 4096,
+    "claude-3-5-sonnet-latest": 4096,
+}
+# 書き込みを別スレッドでまとめてコミットする（write-behind）設定
+WRITE_BEHIND_ENABLED = True
+# ジャーナルはプロセスごとに「WRITE_BEHIND_JOURNAL.<pid>」に作る
+WRITE_BEHIND_JOURNAL = os.environ.get("WRITE_BEHIND_JOURNAL", "write_behind.journal")
+WRITE_BEHIND_MAX_PENDING = 1000
+WRITE_BEHIND_BATCH_SIZE = 100
+WRITE_BEHIND_FLUSH_INTERVAL = 0.05
+WRITE_BEHIND_PUT_TIMEOUT = 5.0
+# コミットに失敗したときの再試行の間隔（指数バックオフ、秒）
+WRITE_BEHIND_RETRY_BASE_DELAY = 0.1
+WRITE_BEHIND_RETRY_MAX_DELAY = 5.0
+# メトリクス（Prometheus形式の/metrics）のポート。0で無効
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9464))
+# この秒数以上かかったクエリをログに出す（未設定の場合は出さない）
+SLOW_QUERY_SECONDS = float(os.environ["SLOW_QUERY_SECONDS"]) if os.environ.get("SLOW_QUERY_SECONDS") else None
+# メトリクスのページを表示できるユーザー名（カンマ区切り）
+ADMIN_USERS = [name.strip() for name in os.environ.get("ADMIN_USERS", "").split(",") if name.strip()]
+# 全文検索の1ページの件数と、スニペットの文字数
+SEARCH_PAGE_SIZE = 10
+SEARCH_SNIPPET_CHARS = 80
+# エクスポート・インポートで1回に読み書きする行数
+EXPORT_BATCH_SIZE = 5000
+# プロバイダ・モデルごとの同時実行数と1分あたりのトークン数の上限（Noneの場合は上限なし）
+SCHEDULER_MAX_CONCURRENCY = int(os.environ.get("SCHEDULER_MAX_CONCURRENCY", 4))
+SCHEDULER_TOKENS_PER_MINUTE = int(os.environ["SCHEDULER_TOKENS_PER_MINUTE"]) if os.environ.get("SCHEDULER_TOKENS_PER_MINUTE") else None
+# "プロバイダ/モデル"ごとの上書き（例: {"OpenAI/gpt-4o": {"max_concurrency": 2, "tokens_per_minute": 30000}}）
+SCHEDULER_LIMITS = {}
+# 応答のトークン数の見積もり（開始時に入力と合わせて予約し、終了時に実際の数で補正する）
+SCHEDULER_OUTPUT_TOKEN_ESTIMATE = 500
+# レート制限・サーバーエラーの再試行（指数バックオフ、秒）
+RETRY_MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 20.0
+# APIの接続先（ローカルのスタブサーバーで試す場合などに指定する）
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL")
+ANTHROPIC_BASE_URL = os.environ.get("ANTHROPIC_BASE_URL")
+# 会話メモリ・ログインセッションを共有する保存先（memory:// / SQLAlchemyのURL / redis://）
+STATE_STORE_URL = os.environ.get("STATE_STORE_URL", "sqlite:///state.db")
+# 保存先に置いた会話メモリを残しておく秒数
+MEMORY_STATE_TTL = 60 * 60 * 24 * 7
@@ -1,11 +1,21 @@
 # database.py
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
 import bcrypt
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, Float, String, Text, DateTime, Index, and_, or_, delete, insert, select
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlalchemy.sql import func
 from datetime import datetime, timezone, timedelta
 
+from tokenizer import count_tokens, truncate_tokens
+from metrics import instrument_engine, RowCountingConnection
+from config import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, SQLITE_BUSY_TIMEOUT_MS, SQLITE_CACHE_SIZE_KB, SQLITE_MMAP_SIZE, SOFT_DELETE, SEARCH_PAGE_SIZE, SEARCH_SNIPPET_CHARS, EXPORT_BATCH_SIZE, ROLLING_SUMMARY_MAX_TOKENS
+
 JST = timezone(timedelta(hours=+9), 'JST')
 def current_time_jst():
     return datetime.now(JST)
@@ -23,6 +33,39 @@ class Message(Base):
     caption = Column(Text)
     timestamp = Column(DateTime, default=current_time_jst)
     summary = Column(Text, nullable=True)
+    # ストリーミング応答の計測値（アシスタントのメッセージのみ）
+    ttft = Column(Float, nullable=True)
+    output_tokens = Column(Integer, nullable=True)
+    tokens_per_sec = Column(Float, nullable=True)
+    # 保存時に一度だけ数えたメッセージのトークン数
+    token_count = Column(Integer, nullable=True)
+    # 同じ往復（ユーザーの入力と応答）のメッセージに共通のID。書き込みの重複を防ぐのに使う
+    turn_id = Column(String, nullable=True, index=True)
+
+    __table_args__ = (
+        # 会話内のキーセットページング用 (timestamp, id) カーソル
+        Index('ix_messages_conversation_timestamp_id', 'conversation_id', 'timestamp', 'id'),
+    )
+
+class Conversation(Base):
+    __tablename__ = 'conversations'
+
+    id = Column(String, primary_key=True)
+    user_id = Column(String, nullable=False)
+    created_at = Column(DateTime, default=current_time_jst)
+    updated_at = Column(DateTime, default=current_time_jst)
+    message_count = Column(Integer, nullable=False, default=0)
+    summary = Column(Text, nullable=True)
+    # 要約を作成した時点のメッセージ数
+    summarized_count = Column(Integer, nullable=True, default=0)
+    # メモリのトークン予算からあふれた古いメッセージの要約と、要約済みの最後のメッセージID
+    rolling_summary = Column(Text, nullable=True)
+    rolling_summary_until_id = Column(Integer, nullable=True, default=0)
+    # 論理削除された日時（SOFT_DELETEが有効な場合のみ使う）
+    deleted_at = Column(DateTime, nullable=True)
+
+# 履歴一覧をインデックスの範囲スキャンで取得するためのインデックス
+Index('ix_conversations_user_updated', Conversation.user_id, Conversation.updated_at.desc())
 
 class User(Base):
     __tablename__ = 'users'
@@ -31,10 +74,181 @@ class User(Base):
     username = Column(String, unique=True, nullable=False)
     password = Column(String, nullable=False)
 
-engine = create_engine('sqlite:///chat_history.db')
-Session = sessionmaker(bind=engine)
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # 接続ごとにWALモードと同期・キャッシュの設定を行う
+    cursor = dbapi_connection.cursor()
+    # 新規作成のDBでは削除後の空きページをincremental_vacuumで解放できるようにする
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+def create_database_engine(url=DATABASE_URL):
+    """DATABASE_URLからコネクションプール付きのエンジンを作成する"""
+    database_url = make_url(url)
+    if database_url.get_backend_name() != "sqlite":
+        return create_engine(
+            url,
+            poolclass=QueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_pre_ping=True,
+        )
+    if database_url.database in (None, "", ":memory:"):
+        # インメモリDBは接続ごとに別のDBになるため1接続を共有する
+        return create_engine(url, poolclass=StaticPool, connect_args={"check_same_thread": False, "factory": RowCountingConnection})
+    sqlite_engine = create_engine(
+        url,
+        poolclass=QueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000, "factory": RowCountingConnection},
+    )
+    event.listen(sqlite_engine, "connect", _set_sqlite_pragmas)
+    return sqlite_engine
+
+engine = create_database_engine()
+# クエリごとの実行時間・行数をメトリクスに記録する
+instrument_engine(engine, "chat_history")
+# セッションを閉じた後も読み込んだ値を参照できるよう、コミット時に属性を期限切れにしない
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+@contextmanager
+def session_scope():
+    """1つのトランザクションで処理を行うセッション。例外時はロールバックする"""
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def add_missing_columns():
+    """既存のテーブルに後から追加されたカラムを作成する"""
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+def create_missing_indexes():
+    """既存のテーブルに後から追加されたインデックスを作成する"""
+    for index in Message.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+def backfill_conversations():
+    """conversationsテーブルが空の場合、既存のmessagesから会話の集計行を作成する"""
+    with session_scope() as session:
+        if session.query(Conversation.id).first() is None:
+            aggregate = select(
+                Message.conversation_id,
+                func.max(Message.user_id),
+                func.min(Message.timestamp),
+                func.max(Message.timestamp),
+                func.count(Message.id),
+                func.max(Message.summary),
+            ).group_by(Message.conversation_id)
+            session.execute(insert(Conversation).from_select(
+                ['id', 'user_id', 'created_at', 'updated_at', 'message_count', 'summary'],
+                aggregate,
+            ))
+
+# SQLiteのFTS5のトークナイザ。trigramは分かち書きのない日本語でも部分一致で検索できる（SQLite 3.34以降）
+SEARCH_TOKENIZER = "trigram" if sqlite3.sqlite_version_info >= (3, 34, 0) else "unicode61"
+# trigramで検索できる最短の語の文字数。これより短い語はLIKEで絞り込む
+SEARCH_MIN_TERM_LENGTH = 3 if SEARCH_TOKENIZER == "trigram" else 1
+
+_SQLITE_SEARCH_DDL = [
+    # メッセージ本文と会話の要約の外部コンテンツ型の索引
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(message, content='messages', content_rowid='id', tokenize='{SEARCH_TOKENIZER}')",
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(summary, content='conversations', content_rowid='rowid', tokenize='{SEARCH_TOKENIZER}')",
+    # 書き込みのたびに索引を更新するトリガー
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS conversations_fts_insert AFTER INSERT ON conversations BEGIN
+        INSERT INTO conversations_fts(rowid, summary) VALUES (new.rowid, new.summary);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS conversations_fts_delete AFTER DELETE ON conversations BEGIN
+        INSERT INTO conversations_fts(conversations_fts, rowid, summary) VALUES ('delete', old.rowid, old.summary);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS conversations_fts_update AFTER UPDATE OF summary ON conversations BEGIN
+        INSERT INTO conversations_fts(conversations_fts, rowid, summary) VALUES ('delete', old.rowid, old.summary);
+        INSERT INTO conversations_fts(rowid, summary) VALUES (new.rowid, new.summary);
+    END""",
+]
+
+_POSTGRESQL_SEARCH_DDL = [
+    # 'simple'は語幹処理をしない設定。本文から自動で計算される列にGINインデックスを張る
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', coalesce(message, ''))) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_messages_search_vector ON messages USING GIN (search_vector)",
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', coalesce(summary, ''))) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_conversations_search_vector ON conversations USING GIN (search_vector)",
+]
 
-Base.metadata.create_all(engine)
+def create_search_index():
+    """メッセージ本文と要約の全文検索インデックスを作成する（SQLiteはFTS5、PostgreSQLはtsvector）"""
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as connection:
+            for statement in _POSTGRESQL_SEARCH_DDL:
+                connection.execute(text(statement))
+    elif engine.dialect.name == "sqlite":
+        with engine.begin() as connection:
+            existing = set(connection.execute(text(
+                "SELECT name FROM sqlite_master WHERE name IN ('messages_fts', 'conversations_fts')"
+            )).scalars())
+            for statement in _SQLITE_SEARCH_DDL:
+                connection.execute(text(statement))
+            # 索引を新しく作った場合は既存の行から作り直す
+            if "messages_fts" not in existing:
+                connection.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+            if "conversations_fts" not in existing:
+                connection.execute(text("INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')"))
+
+def rebuild_search_index():
+    """SQLiteの全文検索インデックスを作り直す
+
+    conversationsは暗黙のrowidで索引と対応付けているため、VACUUMでrowidが変わった後に呼ぶ。
+    """
+    if engine.dialect.name == "sqlite":
+        with engine.begin() as connection:
+            connection.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+            connection.execute(text("INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')"))
+
+_initialized = False
+_init_lock = threading.Lock()
+
+def init_db():
+    """テーブルの作成とマイグレーションを行う。起動時（アプリやCLIの開始時）に一度だけ呼ぶ"""
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        Base.metadata.create_all(engine)
+        add_missing_columns()
+        create_missing_indexes()
+        backfill_conversations()
+        create_search_index()
+        _initialized = True
 
 def hash_password(password):
     """パスワードをハッシュ化する"""
@@ -42,115 +256,465 @@ def hash_password(password):
 
 def check_password(hashed_password, plain_password):
     """ハッシュ化されたパスワードと平文のパスワードを比較する"""
+    if isinstance(hashed_password, str):
+        hashed_password = hashed_password.encode('utf-8')
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password)
 
 def save_user(username, password):
-    session = Session()
-    hashed_password = hash_password(password)
-    new_user = User(username=username, password=hashed_password)
-    session.add(new_user)
-    session.commit()
-    session.close()
+    save_user_with_hash(username, hash_password(password))
+
+def save_user_with_hash(username, hashed_password):
+    """ハッシュ化済みのパスワードでユーザーを保存する"""
+    with session_scope() as session:
+        session.add(User(username=username, password=hashed_password))
 
 def get_user(username):
-    session = Session()
-    user = session.query(User).filter(User.username == username).first()
-    session.close()
-    return user
+    with session_scope() as session:
+        return session.query(User).filter(User.username == username).first()
 
 def get_user_id(username):
     """指定されたユーザー名に基づいてユーザーIDを取得する"""
-    session = Session()
-    user = session.query(User).filter(User.username == username).first()
-    session.close()
+    user = get_user(username)
     if user:
         return user.id
     return None
 
 def authenticate_user(username, password):
+    """ユーザー名とパスワードを照合し、成功すればユーザーを返す"""
     user = get_user(username)
     if user and check_password(user.password, password):
-        return True
-    return False
+        return user
+    return None
+
+def _user_key(user_id):
+    # user_idはString型のカラムに保存するため、バックエンドに関わらず文字列で扱う
+    return None if user_id is None else str(user_id)
+
+def touch_conversation(session, conversation_id, user_id, timestamp, count=1):
+    """メッセージの保存と同じトランザクションで会話の集計行を更新する"""
+    updated = session.query(Conversation).filter(Conversation.id == conversation_id).update(
+        {
+            Conversation.updated_at: timestamp,
+            Conversation.message_count: Conversation.message_count + count,
+        },
+        synchronize_session=False,
+    )
+    if not updated:
+        session.add(Conversation(
+            id=conversation_id,
+            user_id=_user_key(user_id),
+            created_at=timestamp,
+            updated_at=timestamp,
+            message_count=count,
+        ))
 
 def save_conversation(conversation_id, messages):
     """特定の会話IDに属するメッセージリストをデータベースに保存する関数"""
-    session = Session()
-    for message in messages:
-        new_message = Message(conversation_id=conversation_id, **message)
-        session.add(new_message)
-    session.commit()
-    session.close()
+    if not messages:
+        return
+    user_id = messages[0].get("user_id")
+    with session_scope() as session:
+        timestamp = current_time_jst()
+        for message in messages:
+            message = {**message, "user_id": _user_key(message.get("user_id"))}
+            session.add(Message(conversation_id=conversation_id, token_count=count_tokens(message["message"]), **message))
+        touch_conversation(session, conversation_id, user_id, timestamp, len(messages))
 
 def get_conversations(user_id):
-    session = Session()
-    conversations = session.query(
-        Message.conversation_id,
-        func.max(Message.timestamp).label("latest_timestamp")
-    ).filter(
-        Message.user_id == user_id,
-    ).group_by(Message.conversation_id).order_by(func.max(Message.timestamp).desc()).all()
-    session.close()
-    return [(c.conversation_id, c.latest_timestamp) for c in conversations]
+    """ユーザーの会話IDと最終更新日時を新しい順に取得する"""
+    with session_scope() as session:
+        conversations = session.query(
+            Conversation.id,
+            Conversation.updated_at,
+        ).filter(
+            Conversation.user_id == _user_key(user_id),
+            Conversation.deleted_at.is_(None),
+        ).order_by(Conversation.updated_at.desc()).all()
+    return [(c.id, c.updated_at) for c in conversations]
+
+def get_conversations_page(user_id, limit, cursor=None, date_from=None, date_to=None, prefix=None):
+    """ユーザーの会話を新しい順に1ページ分取得し、(会話のリスト, 次ページのカーソル) を返す
+
+    cursorは前ページ最後の (updated_at, id)。date_from/date_toで更新日時を、prefixで要約の前方一致を絞り込む。
+    """
+    with session_scope() as session:
+        query = session.query(
+            Conversation.id,
+            Conversation.updated_at,
+            Conversation.message_count,
+            Conversation.summary,
+        ).filter(Conversation.user_id == _user_key(user_id), Conversation.deleted_at.is_(None))
+        if date_from is not None:
+            query = query.filter(Conversation.updated_at >= date_from)
+        if date_to is not None:
+            query = query.filter(Conversation.updated_at <= date_to)
+        if prefix:
+            query = query.filter(Conversation.summary.startswith(prefix, autoescape=True))
+        if cursor is not None:
+            before_updated_at, before_id = cursor
+            query = query.filter(or_(
+                Conversation.updated_at < before_updated_at,
+                and_(Conversation.updated_at == before_updated_at, Conversation.id < before_id),
+            ))
+        # 次ページの有無を判定するため1件多く取得する
+        rows = query.order_by(Conversation.updated_at.desc(), Conversation.id.desc()).limit(limit + 1).all()
+
+    conversations = [
+        {
+            "id": row.id,
+            "updated_at": row.updated_at,
+            "message_count": row.message_count,
+            "summary": row.summary,
+        }
+        for row in rows[:limit]
+    ]
+    next_cursor = None
+    if len(rows) > limit:
+        last = conversations[-1]
+        next_cursor = (last["updated_at"], last["id"])
+    return conversations, next_cursor
+
+def _like_pattern(term):
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def _fts_query(terms):
+    # 利用者の入力をFTS5の構文として解釈させないよう、語ごとにフレーズとして引用する
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def make_snippet(body, terms, width=SEARCH_SNIPPET_CHARS):
+    """最初に一致した語の周辺を切り出し、一致した語を太字にする"""
+    if not body:
+        return ""
+    folded = body.casefold()
+    positions = [position for position in (folded.find(term.casefold()) for term in terms) if position >= 0]
+    start = max(0, min(positions, default=0) - width // 3)
+    end = min(len(body), start + width)
+    fragment = body[start:end]
+    for term in sorted(terms, key=len, reverse=True):
+        fragment = re.sub(re.escape(term), lambda match: f"**{match.group(0)}**", fragment, flags=re.IGNORECASE)
+    return ("…" if start > 0 else "") + fragment + ("…" if end < len(body) else "")
+
+def _search_statement(terms, dialect):
+    # メッセージと要約の一致を1つの順位付きの結果にまとめるSQLを組み立てる
+    params = {}
+    if dialect == "postgresql":
+        params["query"] = " ".join(terms)
+        message = ("messages m JOIN conversations c ON c.id = m.conversation_id, plainto_tsquery('simple', :query) q",
+                   ["m.search_vector @@ q"], "ts_rank(m.search_vector, q)")
+        summary = ("conversations c, plainto_tsquery('simple', :query) q",
+                   ["c.search_vector @@ q"], "ts_rank(c.search_vector, q)")
+        snippet = "ts_headline('simple', body, plainto_tsquery('simple', :query), 'StartSel=**, StopSel=**, MaxWords=24, MinWords=8')"
+        return message, summary, snippet, params
+
+    min_length = SEARCH_MIN_TERM_LENGTH if dialect == "sqlite" else float("inf")
+    long_terms = [term for term in terms if len(term) >= min_length]
+    short_terms = [term for term in terms if len(term) < min_length]
+    if long_terms:
+        params["match"] = _fts_query(long_terms)
+        # CROSS JOINで結合順を固定し、ユーザーの全メッセージではなく索引の一致から辿らせる
+        message = ["messages_fts CROSS JOIN messages m ON m.id = messages_fts.rowid JOIN conversations c ON c.id = m.conversation_id",
+                   ["messages_fts MATCH :match"], "-bm25(messages_fts)"]
+        summary = ["conversations_fts CROSS JOIN conversations c ON c.rowid = conversations_fts.rowid",
+                   ["conversations_fts MATCH :match"], "-bm25(conversations_fts)"]
+    else:
+        # 索引を使えない短い語だけの場合は、ユーザーのメッセージをLIKEで絞り込み、新しい順に並べる
+        message = ["messages m JOIN conversations c ON c.id = m.conversation_id", [], "0"]
+        summary = ["conversations c", [], "0"]
+    for index, term in enumerate(short_terms):
+        params[f"like_{index}"] = _like_pattern(term)
+        message[1].append(f"m.message LIKE :like_{index} ESCAPE '\\'")
+        summary[1].append(f"c.summary LIKE :like_{index} ESCAPE '\\'")
+    return tuple(message), tuple(summary), None, params
 
-def save_message(sender, message, caption, conversation_id, user_id):
+def search_messages(user_id, query, limit=SEARCH_PAGE_SIZE, offset=0):
+    """ユーザーのメッセージ本文と会話の要約を全文検索し、(結果のリスト, 次ページの有無) を返す
+
+    結果は関連度の高い順（同じ場合は新しい順）で、要約に一致した場合はmessage_idがNoneになる。
+    """
+    terms = query.split()
+    if not terms:
+        return [], False
+    dialect = engine.dialect.name
+    (message_from, message_filters, message_rank), (summary_from, summary_filters, summary_rank), snippet, params = _search_statement(terms, dialect)
+    message_where = " AND ".join(message_filters + ["m.user_id = :user_id", "c.deleted_at IS NULL"])
+    summary_where = " AND ".join(summary_filters + ["c.user_id = :user_id", "c.deleted_at IS NULL"])
+    sql = f"""
+        SELECT message_id, conversation_id, sender, timestamp, body, title, rank FROM (
+            SELECT m.id AS message_id, m.conversation_id AS conversation_id, m.sender AS sender, m.timestamp AS timestamp,
+                   m.message AS body, c.summary AS title, {message_rank} AS rank
+            FROM {message_from} WHERE {message_where}
+            UNION ALL
+            SELECT NULL, c.id, NULL, c.updated_at, c.summary, c.summary, {summary_rank}
+            FROM {summary_from} WHERE {summary_where}
+        ) AS results
+        ORDER BY rank DESC, timestamp DESC
+        LIMIT :limit OFFSET :offset
+    """
+    if snippet is not None:
+        # 切り出しは表示するページの行だけで行う
+        sql = f"""
+            SELECT message_id, conversation_id, sender, timestamp, {snippet} AS body, title, rank
+            FROM ({sql}) AS page ORDER BY rank DESC, timestamp DESC
+        """
+    # 次ページの有無を判定するため1件多く取得する
+    params.update({"user_id": _user_key(user_id), "limit": limit + 1, "offset": offset})
+    with session_scope() as session:
+        rows = session.execute(text(sql).columns(timestamp=DateTime), params).all()
+    results = [
+        {
+            "message_id": row.message_id,
+            "conversation_id": row.conversation_id,
+            "sender": row.sender,
+            "timestamp": row.timestamp,
+            "cursor": (row.timestamp, row.message_id) if row.message_id is not None else None,
+            "title": row.title,
+            "snippet": row.body if snippet is not None else make_snippet(row.body, terms),
+        }
+        for row in rows[:limit]
+    ]
+    return results, len(rows) > limit
+
+def _new_message(sender, message, caption, conversation_id, user_id, timestamp, ttft=None, output_tokens=None, tokens_per_sec=None, turn_id=None):
+    return Message(
+        sender=sender, message=message, caption=caption, conversation_id=conversation_id, user_id=_user_key(user_id), timestamp=timestamp,
+        ttft=ttft, output_tokens=output_tokens, tokens_per_sec=tokens_per_sec, token_count=count_tokens(message), turn_id=turn_id,
+    )
+
+def save_message(sender, message, caption, conversation_id, user_id, ttft=None, output_tokens=None, tokens_per_sec=None):
     """Save a message to the database."""
-    session = Session()
-    new_message = Message(sender=sender, message=message, caption=caption, conversation_id=conversation_id, user_id=user_id)
-    session.add(new_message)
-    session.commit()
-    session.close()
+    with session_scope() as session:
+        timestamp = current_time_jst()
+        session.add(_new_message(sender, message, caption, conversation_id, user_id, timestamp, ttft, output_tokens, tokens_per_sec))
+        touch_conversation(session, conversation_id, user_id, timestamp)
+
+def save_turn(conversation_id, user_id, user_message, assistant_messages, turn_id=None, timestamp=None):
+    """ユーザーのメッセージとアシスタントの応答（複数可）を1つのトランザクションで保存する
+
+    assistant_messagesは {"message", "caption", "ttft", "output_tokens", "tokens_per_sec"} の辞書のリスト。
+    """
+    save_turns([{
+        "turn_id": turn_id,
+        "conversation_id": conversation_id,
+        "user_id": user_id,
+        "user_message": user_message,
+        "assistant_messages": assistant_messages,
+        "timestamp": timestamp,
+    }])
+
+def save_turns(turns):
+    """複数の往復を1つのトランザクションでまとめて保存する（グループコミット）
+
+    turn_idが既に保存されている往復は保存しないため、同じ往復を再送しても重複しない。
+    """
+    turn_ids = [turn["turn_id"] for turn in turns if turn.get("turn_id")]
+    with session_scope() as session:
+        saved_turn_ids = set()
+        if turn_ids:
+            saved_turn_ids = {row.turn_id for row in session.query(Message.turn_id).filter(Message.turn_id.in_(turn_ids)).distinct()}
+        for turn in turns:
+            if turn.get("turn_id") in saved_turn_ids:
+                continue
+            timestamp = turn.get("timestamp") or current_time_jst()
+            conversation_id, user_id, turn_id = turn["conversation_id"], turn["user_id"], turn.get("turn_id")
+            session.add(_new_message("User", turn["user_message"], "", conversation_id, user_id, timestamp, turn_id=turn_id))
+            for assistant_message in turn["assistant_messages"]:
+                session.add(_new_message("Assistant", conversation_id=conversation_id, user_id=user_id, timestamp=timestamp, turn_id=turn_id, **assistant_message))
+            touch_conversation(session, conversation_id, user_id, timestamp, 1 + len(turn["assistant_messages"]))
+            # 同じバッチ内に同じ会話が続く場合に備えて、新規の会話行をすぐに反映する
+            session.flush()
+
+def iter_messages(user_id=None, date_from=None, date_to=None, batch_size=EXPORT_BATCH_SIZE):
+    """メッセージを1行ずつ辞書で返すイテレータ
+
+    yield_perでbatch_size行ずつ取得するため（PostgreSQLではサーバーサイドカーソルを使う）、
+    件数に関わらずメモリ使用量は一定になる。
+    """
+    query = select(Message.__table__).order_by(Message.id)
+    if user_id is not None:
+        query = query.where(Message.user_id == _user_key(user_id))
+    if date_from is not None:
+        query = query.where(Message.timestamp >= date_from)
+    if date_to is not None:
+        query = query.where(Message.timestamp <= date_to)
+    with engine.connect() as connection:
+        result = connection.execution_options(yield_per=batch_size).execute(query)
+        for row in result.mappings():
+            yield dict(row)
 
 def load_messages():
     """Load all messages from the database and return them as a list of dictionaries."""
-    session = Session()
-    messages = session.query(Message).order_by(Message.timestamp.asc()).all()
-    session.close()
+    with session_scope() as session:
+        messages = session.query(Message).order_by(Message.timestamp.asc()).all()
     return messages_to_dict_list(messages)
 
 def messages_to_dict_list(messages):
     """Convert a list of Message instances to a list of dictionaries."""
     return [
         {
+            "id": message.id,
             "sender": message.sender,
             "message": message.message,
             "timestamp": message.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
             "caption": message.caption,
+            "cursor": (message.timestamp, message.id),
+            "token_count": message.token_count if message.token_count is not None else count_tokens(message.message),
+            "turn_id": message.turn_id,
+        }
+        for message in messages
+    ]
+
+def turn_to_dict_list(turn):
+    """save_turnsに渡す往復を、messages_to_dict_listと同じ形式の辞書のリストにする"""
+    timestamp = turn.get("timestamp") or current_time_jst()
+    messages = [{"sender": "User", "message": turn["user_message"], "caption": ""}]
+    messages += [
+        {"sender": "Assistant", "message": assistant_message["message"], "caption": assistant_message.get("caption")}
+        for assistant_message in turn["assistant_messages"]
+    ]
+    return [
+        {
+            "id": None,
+            "timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+            "cursor": None,
+            "token_count": count_tokens(message["message"]),
+            "turn_id": turn.get("turn_id"),
+            **message,
         }
         for message in messages
     ]
 
 def load_messages_by_conversation_id(conversation_id):
     """指定された会話IDに基づいてメッセージをロードする"""
-    session = Session()
-    messages = session.query(Message).filter(Message.conversation_id == conversation_id).order_by(Message.timestamp.asc()).all()
-    session.close()
+    with session_scope() as session:
+        messages = session.query(Message).filter(Message.conversation_id == conversation_id).order_by(Message.timestamp.asc()).all()
     return messages_to_dict_list(messages)
 
-def save_summary(summary, conversation_id):
-    """指定された会話IDの会話に要約を保存する"""
-    session = Session()
-    # 会話の最初のメッセージを取得して要約を更新する例
-    message = session.query(Message).filter(Message.conversation_id == conversation_id).first()
-    if message:
-        message.summary = summary
-        session.commit()
-    session.close()
+def load_messages_after(conversation_id, after_id):
+    """指定された会話IDのうち、after_idより新しいメッセージだけをロードする"""
+    with session_scope() as session:
+        messages = session.query(Message).filter(
+            Message.conversation_id == conversation_id,
+            Message.id > after_id,
+        ).order_by(Message.id.asc()).all()
+    return messages_to_dict_list(messages)
+
+def load_recent_messages(conversation_id, limit):
+    """指定された会話IDの最新limit件のメッセージを古い順でロードする"""
+    with session_scope() as session:
+        messages = session.query(Message).filter(
+            Message.conversation_id == conversation_id,
+        ).order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
+    return messages_to_dict_list(reversed(messages))
+
+def load_messages_before(conversation_id, cursor, limit):
+    """(timestamp, id) カーソルより古いメッセージをlimit件、古い順でロードする"""
+    before_timestamp, before_id = cursor
+    with session_scope() as session:
+        messages = session.query(Message).filter(
+            Message.conversation_id == conversation_id,
+            or_(
+                Message.timestamp < before_timestamp,
+                and_(Message.timestamp == before_timestamp, Message.id < before_id),
+            ),
+        ).order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
+    return messages_to_dict_list(reversed(messages))
+
+def load_messages_between(conversation_id, from_cursor, before_cursor):
+    """(timestamp, id) カーソルfrom_cursor以降、before_cursorより古いメッセージを古い順でロードする"""
+    from_timestamp, from_id = from_cursor
+    before_timestamp, before_id = before_cursor
+    with session_scope() as session:
+        messages = session.query(Message).filter(
+            Message.conversation_id == conversation_id,
+            or_(
+                Message.timestamp > from_timestamp,
+                and_(Message.timestamp == from_timestamp, Message.id >= from_id),
+            ),
+            or_(
+                Message.timestamp < before_timestamp,
+                and_(Message.timestamp == before_timestamp, Message.id < before_id),
+            ),
+        ).order_by(Message.timestamp.asc(), Message.id.asc()).all()
+    return messages_to_dict_list(messages)
+
+def _token_window(session, conversation_id, after_id):
+    # 新しいメッセージから遡ったトークン数の累計を持つサブクエリ
+    # トークン数が未計算の古い行は文字数で代用する
+    tokens = func.coalesce(Message.token_count, func.length(Message.message))
+    running = func.sum(tokens).over(order_by=(Message.timestamp.desc(), Message.id.desc()))
+    return session.query(
+        Message.id.label("id"),
+        running.label("running_tokens"),
+    ).filter(
+        Message.conversation_id == conversation_id,
+        Message.id > (after_id or 0),
+    ).subquery()
+
+def load_messages_within_budget(conversation_id, budget, after_id=0):
+    """after_idより新しいメッセージのうち、最新から遡ってトークン予算に収まる分を古い順でロードする"""
+    with session_scope() as session:
+        window = _token_window(session, conversation_id, after_id)
+        ids = session.query(window.c.id).filter(window.c.running_tokens <= budget)
+        messages = session.query(Message).filter(Message.id.in_(ids)).order_by(Message.timestamp.asc(), Message.id.asc()).all()
+    return messages_to_dict_list(messages)
+
+def load_messages_outside_budget(conversation_id, budget, after_id=0, limit=100):
+    """after_idより新しいメッセージのうち、トークン予算からあふれた古いメッセージを古い順でロードする"""
+    with session_scope() as session:
+        window = _token_window(session, conversation_id, after_id)
+        ids = session.query(window.c.id).filter(window.c.running_tokens > budget)
+        messages = session.query(Message).filter(Message.id.in_(ids)).order_by(Message.timestamp.asc(), Message.id.asc()).limit(limit).all()
+    return messages_to_dict_list(messages)
+
+def save_rolling_summary(conversation_id, rolling_summary, until_id):
+    """会話のローリング要約と、要約済みの最後のメッセージIDを保存する
+
+    要約はメモリの予算からROLLING_SUMMARY_MAX_TOKENSだけ差し引いて使うため、それを超える分は切り詰める。
+    """
+    with session_scope() as session:
+        conversation = session.get(Conversation, conversation_id)
+        if conversation:
+            conversation.rolling_summary = truncate_tokens(rolling_summary, ROLLING_SUMMARY_MAX_TOKENS)
+            conversation.rolling_summary_until_id = until_id
+
+def save_summary(summary, conversation_id, message_count=None):
+    """指定された会話IDの会話に要約を保存する
+
+    message_countには要約の対象としたメッセージ数を渡す（次回の要約の要否判定に使う）。
+    """
+    with session_scope() as session:
+        conversation = session.get(Conversation, conversation_id)
+        if conversation:
+            conversation.summary = summary
+            if message_count is not None:
+                conversation.summarized_count = message_count
 
 def get_summary(conversation_id):
     """指定された会話IDの会話の要約を取得する"""
-    session = Session()
-    message = session.query(Message).filter(Message.conversation_id == conversation_id).first()
-    session.close()
-    if message and message.summary:
-        return message.summary
+    conversation = get_conversation(conversation_id)
+    if conversation and conversation.summary:
+        return conversation.summary
     return None
 
-def delete_conversation(conversation_id):
-    """指定された会話IDの会話を削除する。"""
-    session = Session()
-    messages_to_delete = session.query(Message).filter(Message.conversation_id == conversation_id).all()
-    for message in messages_to_delete:
-        session.delete(message)
-    session.commit()
-    session.close()
+def get_conversation(conversation_id):
+    """指定された会話IDの会話の集計行を取得する"""
+    with session_scope() as session:
+        return session.get(Conversation, conversation_id)
+
+def delete_conversation(conversation_id, soft=SOFT_DELETE):
+    """指定された会話IDの会話を削除する。
+
+    softがTrueの場合は会話を論理削除し、メッセージは保持期間のジョブでまとめて削除する。
+    """
+    with session_scope() as session:
+        conversation = session.get(Conversation, conversation_id)
+        if soft and conversation:
+            conversation.deleted_at = current_time_jst()
+        else:
+            purge_conversations(session, [conversation_id])
+
+def purge_conversations(session, conversation_ids):
+    """会話とそのメッセージを一括のDELETE文で削除する"""
+    session.execute(delete(Message).where(Message.conversation_id.in_(conversation_ids)))
+    session.execute(delete(Conversation).where(Conversation.id.in_(conversation_ids)))
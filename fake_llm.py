@@ -0,0 +1,57 @@
+# fake_llm.py
+import random
+import time
+import zlib
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+FAKE_PROVIDER = "Fake"
+_WORDS = ["データ", "会話", "応答", "モデル", "検索", "要約", "履歴", "設定", "処理", "結果", "速度", "計測"]
+
+
+class FakeChatModel(BaseChatModel):
+    """APIを呼ばずに決まった速度で応答を返すチャットモデル（ベンチマーク用）
+
+    応答は最後のメッセージとseedから決まるため、同じ入力には常に同じ応答を返す。
+    """
+
+    ttft: float = 0.2
+    tokens_per_sec: float = 50.0
+    response_tokens: int = 64
+    seed: int = 0
+
+    @property
+    def _llm_type(self):
+        return "fake-chat-model"
+
+    def _tokens(self, messages):
+        content = messages[-1].content if messages else ""
+        rng = random.Random(self.seed ^ zlib.crc32(str(content).encode("utf-8")))
+        return [rng.choice(_WORDS) + ("。" if i % 8 == 7 else "、") for i in range(self.response_tokens)]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self._tokens(messages)
+        time.sleep(self.ttft + len(tokens) / self.tokens_per_sec)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self.ttft)
+        interval = 1 / self.tokens_per_sec
+        for i, token in enumerate(self._tokens(messages)):
+            if i:
+                time.sleep(interval)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+def register_fake_provider(ttft=0.2, tokens_per_sec=50.0, response_tokens=64, seed=0):
+    """FakeChatModelをLLMのプロバイダ"Fake"として登録する"""
+    from llm import register_provider
+
+    register_provider(FAKE_PROVIDER, lambda llm: FakeChatModel(
+        ttft=ttft, tokens_per_sec=tokens_per_sec, response_tokens=response_tokens, seed=seed,
+    ))
@@ -1,88 +1,388 @@
 # llm.py
-from operator import itemgetter
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+from time import monotonic, perf_counter
 
-from streamlit.runtime.state import SessionStateProxy
-
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.memory import ConversationBufferMemory, ConversationBufferWindowMemory
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.runnables import RunnableLambda
+
+from response_cache import response_cache
+from state_store import state_store
+from metrics import LLM_INIT_SECONDS, LLM_TTFT_SECONDS, LLM_STREAM_SECONDS
+from scheduler import get_scheduler
+from tokenizer import count_tokens, truncate_tokens
+from config import (
+    CLIENT_POOL_MAX_SIZE, CLIENT_IDLE_TIMEOUT, RESPONSE_CACHE_ENABLED, MEMORY_TOKEN_BUDGET, MODEL_MEMORY_TOKEN_BUDGETS,
+    OPENAI_BASE_URL, ANTHROPIC_BASE_URL, MEMORY_STATE_TTL, ROLLING_SUMMARY_MAX_TOKENS,
+)
+
+logger = logging.getLogger(__name__)
 
 USER_NAME = "user"
 ASSISTANT_NAME = "assistant"
+CACHE_REPLAY_CHUNK_SIZE = 16
+
+
+def _hash_api_key(api_key):
+    # APIキーを平文のままキーに持たないようにハッシュ化する
+    if not api_key:
+        return ""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class ClientPool:
+    """プロセス全体で共有するチャットモデルクライアントのLRUプール"""
+
+    def __init__(self, max_size=CLIENT_POOL_MAX_SIZE, idle_timeout=CLIENT_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_provider, model_name, temperature, api_key, factory):
+        """キーに対応するクライアントを返す。なければfactoryで生成して登録する
+
+        プールから外したクライアントは閉じない。他のセッションのLLMやストリームがまだ使っている
+        場合があるため、参照がなくなったときにガベージコレクションで接続を解放させる。
+        """
+        key = (model_provider, model_name, temperature, _hash_api_key(api_key))
+        with self._lock:
+            now = monotonic()
+            self._drop_idle(now)
+            entry = self._clients.get(key)
+            if entry is not None:
+                entry[1] = now
+                self._clients.move_to_end(key)
+                return entry[0]
+        # 生成（初回はSDKのインポートを含む）に時間がかかっても他のセッションを待たせないよう、ロックの外で生成する
+        model = factory()
+        with self._lock:
+            now = monotonic()
+            entry = self._clients.get(key)
+            if entry is None:
+                # 同時に生成された場合は先に登録されたほうを使う
+                entry = self._clients[key] = [model, now]
+                while len(self._clients) > self.max_size:
+                    self._clients.popitem(last=False)
+            else:
+                entry[1] = now
+                self._clients.move_to_end(key)
+            return entry[0]
+
+    def _drop_idle(self, now):
+        # 一定時間使われていないクライアントを取り除く
+        idle_keys = [key for key, (_, last_used) in self._clients.items() if now - last_used > self.idle_timeout]
+        for key in idle_keys:
+            del self._clients[key]
+
+    def __len__(self):
+        return len(self._clients)
+
+
+client_pool = ClientPool()
+
+
+def get_memory_token_budget(model_name):
+    """モデルごとの会話メモリのトークン予算を返す"""
+    return MODEL_MEMORY_TOKEN_BUDGETS.get(model_name, MEMORY_TOKEN_BUDGET)
+
+
+class TokenBudgetMemory:
+    """トークン予算の範囲で新しいメッセージから遡って会話履歴を返すメモリ
+
+    最も小さいモデルの予算からあふれた古いメッセージはローリング要約（rolling summary）として
+    システムプロンプトに含める。要約の更新はバックグラウンドの要約サービスが行う。
+    要約に取り込まれたメッセージは、同じ内容を二重に送らないよう会話履歴には含めない。
+    """
+
+    def __init__(self, capacity=None):
+        # 保持するトークン数の上限（どのモデルの予算にも足りるよう最大値を使う）
+        self.capacity = capacity or max([MEMORY_TOKEN_BUDGET, *MODEL_MEMORY_TOKEN_BUDGETS.values()])
+        self.messages = deque()
+        self.total_tokens = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self.summary_until_id = 0
+        # 取り込んだ保存済みのメッセージの最大ID（これより新しいメッセージだけを追加で読み込めばよい）
+        self.last_id = 0
+
+    def add_messages(self, messages):
+        """メッセージを追加し、上限を超えた古いメッセージを捨てる"""
+        # 保存前に追加した往復が、保存された後に読み込まれたり、もう一度追加されたりしても重複させない
+        turn_ids = {entry["turn_id"] for entry in self.messages if entry["turn_id"] is not None}
+        local_turn_ids = {entry["turn_id"] for entry in self.messages if entry["id"] is None}
+        for message in messages:
+            message_id = message.get("id")
+            if message_id is not None:
+                if message_id <= self.last_id:
+                    continue
+                self.last_id = message_id
+                if message.get("turn_id") in local_turn_ids:
+                    continue
+            elif message.get("turn_id") in turn_ids:
+                continue
+            tokens = message.get("token_count")
+            if tokens is None:
+                tokens = count_tokens(message["message"])
+            self.messages.append({
+                "id": message_id, "turn_id": message.get("turn_id"), "sender": message["sender"],
+                "message": message["message"], "tokens": tokens,
+            })
+            self.total_tokens += tokens
+        while self.messages and self.total_tokens > self.capacity:
+            self.total_tokens -= self.messages.popleft()["tokens"]
+
+    def set_summary(self, summary, until_id):
+        """ローリング要約を設定する（要約済みのメッセージは会話履歴に含めなくなる）"""
+        # 会話履歴に使える予算が想定より減らないよう、要約の長さを上限に収める
+        self.summary = truncate_tokens(summary or "", ROLLING_SUMMARY_MAX_TOKENS)
+        self.summary_tokens = count_tokens(self.summary)
+        self.summary_until_id = until_id or 0
+
+    def save_context(self, inputs, outputs):
+        self.add_messages([
+            {"sender": "User", "message": inputs["input"]},
+            {"sender": "Assistant", "message": outputs["output"]},
+        ])
+
+    def load_memory_variables(self, inputs=None, budget=None):
+        """予算に収まる会話履歴と、ローリング要約を返す"""
+        remaining = (budget or self.capacity) - self.summary_tokens
+        selected = []
+        for entry in reversed(self.messages):
+            if self.summary and entry["id"] is not None and entry["id"] <= self.summary_until_id:
+                break
+            if entry["tokens"] > remaining:
+                break
+            remaining -= entry["tokens"]
+            selected.append(entry)
+        selected.reverse()
+        # 履歴はユーザーのメッセージから始める
+        while selected and selected[0]["sender"] != "User":
+            selected.pop(0)
+        chat_history = [
+            HumanMessage(content=entry["message"]) if entry["sender"] == "User" else AIMessage(content=entry["message"])
+            for entry in selected
+        ]
+        rolling_summary = f"\n\nこれまでの会話の要約:\n{self.summary}" if self.summary else ""
+        return {"chat_history": chat_history, "rolling_summary": rolling_summary}
+
+    def clear(self):
+        self.messages.clear()
+        self.total_tokens = 0
+        self.last_id = 0
+        self.set_summary("", 0)
+
+    def to_dict(self):
+        """状態の保存先に置くための、JSONにできる辞書にする"""
+        return {
+            "messages": list(self.messages),
+            "summary": self.summary,
+            "summary_until_id": self.summary_until_id,
+            "last_id": self.last_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """to_dictの辞書からメモリを復元する"""
+        memory = cls()
+        memory.set_summary(data["summary"], data["summary_until_id"])
+        memory.last_id = data["last_id"]
+        for entry in data["messages"]:
+            memory.messages.append(entry)
+            memory.total_tokens += entry["tokens"]
+        while memory.messages and memory.total_tokens > memory.capacity:
+            memory.total_tokens -= memory.messages.popleft()["tokens"]
+        return memory
+
+
+def create_memory():
+    """会話ごとのメモリを生成する"""
+    return TokenBudgetMemory()
+
+
+def append_messages_to_memory(memory, messages):
+    """新しいメッセージだけをメモリに追加する"""
+    memory.add_messages(messages)
+
+
+def load_memory_state(conversation_id):
+    """状態の保存先から会話のメモリを復元する。ない場合はNoneを返す"""
+    data = state_store.get(f"memory:{conversation_id}")
+    return TokenBudgetMemory.from_dict(data) if data is not None else None
+
+
+def save_memory_state(conversation_id, memory):
+    """他のプロセスでも使えるよう、会話のメモリを状態の保存先に置く"""
+    state_store.set(f"memory:{conversation_id}", memory.to_dict(), ttl=MEMORY_STATE_TTL)
+
+
+def delete_memory_state(conversation_id):
+    state_store.delete(f"memory:{conversation_id}")
+
+
+# プロバイダのSDKは読み込みに時間がかかるため、そのプロバイダのモデルを最初に作るときに読み込む
+# 再試行はスケジューラが行うため、SDK自身の再試行は無効にする
+def _create_openai_model(llm):
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(model_name=llm.model_name, temperature=llm.temperature, streaming=True, openai_api_key=llm.openai_api_key,
+                      openai_api_base=OPENAI_BASE_URL, max_retries=0)
+
+
+def _create_anthropic_model(llm):
+    from langchain_anthropic import ChatAnthropic
+
+    model = ChatAnthropic(model_name=llm.model_name, temperature=llm.temperature, streaming=True, anthropic_api_key=llm.anthropic_api_key)
+    # このバージョンのChatAnthropicは再試行回数と接続先を指定できないため、SDKクライアントを差し替える
+    options = {"max_retries": 0}
+    if ANTHROPIC_BASE_URL:
+        options["base_url"] = ANTHROPIC_BASE_URL
+    object.__setattr__(model, "_client", model._client.with_options(**options))
+    return model
+
+
+# プロバイダ名 -> (LLMインスタンスからチャットモデルを作る関数, APIキーを持つ属性名)
+_providers = {
+    "OpenAI": (_create_openai_model, "openai_api_key"),
+    "Anthropic": (_create_anthropic_model, "anthropic_api_key"),
+}
+
+
+def register_provider(name, create_model, api_key_attr=None):
+    """LLMで使えるプロバイダを追加する（ベンチマーク用のフェイクモデルなど）"""
+    _providers[name] = (create_model, api_key_attr)
+
 
 class LLM:
-    def __init__(self, model_provider="OpenAI", model_name="gpt-3.5-turbo", temperature=0, system_message="", openai_api_key=None, anthropic_api_key=None):
+    def __init__(self, model_provider="OpenAI", model_name="gpt-3.5-turbo", temperature=0, system_message="", openai_api_key=None, anthropic_api_key=None, memory=None):
         self.model_provider = model_provider
         self.model_name = model_name
         self.temperature = temperature
         self.system_message = system_message
         self.openai_api_key = openai_api_key
         self.anthropic_api_key = anthropic_api_key
-        # ここでメモリの初期化を行う
-        self.state = {"memory": ConversationBufferWindowMemory(k=10, return_messages=True, memory_key="chat_history")}
-        self.prompt = self.__setting_prompt()
-        self.model = self.__setting_model()
-        self.chain = self.__setting_chain()
+        self.memory_token_budget = get_memory_token_budget(model_name)
+        # 直前のstreamの応答がキャッシュから返されたかどうか
+        self.last_cache_hit = False
+        # ここでメモリの初期化を行う（会話キャッシュのメモリが渡された場合はそれを使う）
+        self.state = {"memory": memory if memory is not None else create_memory()}
+        with LLM_INIT_SECONDS.time(provider=model_provider, model=model_name):
+            self.prompt = self.__setting_prompt()
+            self.model = self.__setting_model()
+            self.chain = self.__setting_chain()
+        self.scheduler = get_scheduler(model_provider, model_name)
     
     def __setting_prompt(self):
         # プロンプトの設定
         prompt = ChatPromptTemplate.from_messages([
-            ("system", self.system_message),
+            ("system", self.system_message + "{rolling_summary}"),
             MessagesPlaceholder(variable_name="chat_history"),
             ("human", "{input}")
         ])
         return prompt
     
     def __setting_model(self):
-        # モデルの設定
-        if self.model_provider == "OpenAI":
-            ChatModel = ChatOpenAI
-            model = ChatModel(model_name=self.model_name, temperature=self.temperature, streaming=True, openai_api_key=self.openai_api_key)
-        elif self.model_provider == "Anthropic":
-            ChatModel = ChatAnthropic
-            model = ChatModel(model_name=self.model_name, temperature=self.temperature, streaming=True, anthropic_api_key=self.anthropic_api_key)
-        return model
+        # モデルの設定（プロセス共有のプールから取得する）
+        if self.model_provider not in _providers:
+            raise ValueError(f"未対応のプロバイダです: {self.model_provider}")
+        create_model, api_key_attr = _providers[self.model_provider]
+        api_key = getattr(self, api_key_attr) if api_key_attr else None
+        factory = lambda: create_model(self)
+        return client_pool.get(self.model_provider, self.model_name, self.temperature, api_key, factory)
     
     def __setting_chain(self):
         # 実行チェーンの設定
         chain = (
-            RunnablePassthrough.assign(
-                chat_history=RunnableLambda(self.state["memory"].load_memory_variables) | itemgetter("chat_history")
-            )
+            RunnableLambda(lambda inputs: {**inputs, **self.load_memory()})
             | self.prompt
             | self.model
         )
         return chain
     
-    def stream(self, input_text):
-        # 入力テキストに対するストリーム応答
-        return self.chain.stream({'input': input_text})
+    def stream(self, input_text, on_queue=None):
+        # 入力テキストに対するストリーム応答（キャッシュがあればそれを返す）
+        # APIへのリクエストはスケジューラで順番待ちをし、待っている間はon_queue(順番)を呼ぶ
+        self.last_cache_hit = False
+        memory = self.load_memory()
+        if not RESPONSE_CACHE_ENABLED:
+            return self.__timed(self.__scheduled_stream(input_text, memory, on_queue), cached=False)
+        cache_args = (self.model_provider, self.model_name, self.temperature, self.system_message + memory["rolling_summary"], memory["chat_history"], input_text)
+        try:
+            cached = response_cache.get(*cache_args)
+        except Exception:
+            # キャッシュが使えなくても応答は返す
+            logger.exception("応答キャッシュの読み込みに失敗しました")
+            cached = None
+        if cached is not None:
+            self.last_cache_hit = True
+            return self.__timed(self.__replay(cached), cached=True)
+        return self.__timed(self.__stream_and_cache(cache_args, memory, on_queue), cached=False)
+
+    def __input_tokens(self, input_text, memory):
+        # スケジューラのトークン予算に使う、リクエストの入力トークン数
+        texts = [self.system_message, memory["rolling_summary"], input_text, *(message.content for message in memory["chat_history"])]
+        return sum(count_tokens(text) for text in texts)
+
+    def __scheduled_stream(self, input_text, memory, on_queue):
+        create_stream = lambda: self.chain.stream({'input': input_text})
+        return self.scheduler.stream(create_stream, self.__input_tokens(input_text, memory), on_queue)
+
+    def __timed(self, chunks, cached):
+        # 最初のチャンクまでの時間とストリームが終わるまでの時間をメトリクスに記録する
+        labels = {"provider": self.model_provider, "model": self.model_name, "cached": str(cached).lower()}
+        start = perf_counter()
+        first_chunk = True
+        try:
+            for chunk in chunks:
+                if first_chunk and chunk.content:
+                    LLM_TTFT_SECONDS.observe(perf_counter() - start, **labels)
+                    first_chunk = False
+                yield chunk
+        finally:
+            LLM_STREAM_SECONDS.observe(perf_counter() - start, **labels)
+
+    def __replay(self, text):
+        # キャッシュされた応答を通常のストリームと同じ形で返す
+        for i in range(0, len(text), CACHE_REPLAY_CHUNK_SIZE):
+            yield AIMessageChunk(content=text[i:i + CACHE_REPLAY_CHUNK_SIZE])
+
+    def __stream_and_cache(self, cache_args, memory, on_queue):
+        # ストリーム応答を返しつつ、最後まで受け取れた応答をキャッシュに保存する
+        parts = []
+        for chunk in self.__scheduled_stream(cache_args[-1], memory, on_queue):
+            parts.append(chunk.content)
+            yield chunk
+        try:
+            response_cache.put(*cache_args, "".join(parts))
+        except Exception:
+            # 応答は表示済みのため、保存に失敗しても往復の保存まで進める
+            logger.exception("応答キャッシュへの保存に失敗しました")
 
     def invoke(self, input_text):
         # 入力テキストに対する一回の応答
-        return self.chain.invoke({'input': input_text})
+        input_tokens = self.__input_tokens(input_text, self.load_memory())
+        return self.scheduler.call(lambda: self.chain.invoke({'input': input_text}), input_tokens, lambda result: count_tokens(result.content))
 
     def save_memory(self, input_text, output_text):
         # 会話のメモリへの保存
         self.state["memory"].save_context({"input": input_text}, {"output": output_text})
 
     def load_memory(self):
-        # メモリの読み込み
-        return self.state["memory"].load_memory_variables({})
+        # メモリの読み込み（モデルのトークン予算に収まる分）
+        return self.state["memory"].load_memory_variables({}, budget=self.memory_token_budget)
+
+    def set_memory(self, memory):
+        # 会話ごとのメモリを差し替える
+        self.state["memory"] = memory
 
     def load_messages_into_memory(self, messages):
         # メッセージリストをメモリにロード
         self.reset_memory()
-        # messagesリストがユーザーのメッセージとAIの応答のペアを含んでいると仮定して処理
-        for i in range(0, len(messages), 2):
-            user_message = messages[i]["message"]  # ユーザーからのメッセージ
-            if i + 1 < len(messages):
-                ai_response = messages[i + 1]["message"]  # AIからの応答
-            else:
-                ai_response = ""  # 最後のメッセージがユーザーからの場合、AIの応答は空
-            self.save_memory(user_message, ai_response)
+        append_messages_to_memory(self.state["memory"], messages)
 
     def reset_memory(self):
         # メモリのリセット
@@ -101,10 +401,26 @@ _system_message = """
     - 会話履歴と含まれない内容を出力しないでください。
     """
 
-def summarize(conversation_text, model_provider="OpenAI", model_name="gpt-4o-mini", temperature=0, system_message=_system_message):
+_rolling_summary_system_message = """
+    ルール：
+    - 入力は「これまでの要約」と「新しい会話」です。両方の内容を統合した会話の要約を出力してください。
+    - 後の会話で参照できるよう、ユーザーの質問や前提条件、決まったことを優先して残してください。
+    - 要約は500文字以内にしてください。
+    - 要約以外の余分な言葉は出力しないでください。
+    """
+
+def update_rolling_summary(previous_summary, conversation_text, model_provider="OpenAI", model_name="gpt-4o-mini", openai_api_key=None, anthropic_api_key=None):
+    """
+    これまでの要約に新しい会話を取り込んだローリング要約を生成する。
+    """
+    text = f"これまでの要約:\n{previous_summary or 'なし'}\n\n新しい会話:\n{conversation_text}"
+    return summarize(text, model_provider=model_provider, model_name=model_name, system_message=_rolling_summary_system_message,
+                     openai_api_key=openai_api_key, anthropic_api_key=anthropic_api_key)
+
+def summarize(conversation_text, model_provider="OpenAI", model_name="gpt-4o-mini", temperature=0, system_message=_system_message, openai_api_key=None, anthropic_api_key=None):
     """
     会話テキストから要約を生成する。
     """
-    llm = LLM(model_provider=model_provider, model_name=model_name, temperature=temperature, system_message=system_message)
+    llm = LLM(model_provider=model_provider, model_name=model_name, temperature=temperature, system_message=system_message, openai_api_key=openai_api_key, anthropic_api_key=anthropic_api_key)
     summary = llm.invoke(conversation_text).content
     return summary
\ No newline at end of file
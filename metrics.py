@@ -0,0 +1,283 @@
+# metrics.py
+import logging
+import hashlib
+import re
+import sqlite3
+import threading
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, time
+
+from sqlalchemy import event
+
+from config import METRICS_HOST, METRICS_PORT, SLOW_QUERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROW_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 100000)
+FINGERPRINT_MAX_LENGTH = 200
+SLOW_QUERY_LOG_SIZE = 100
+
+
+class Histogram:
+    """ラベルの組み合わせごとに、バケットごとの件数・合計・件数を集計するヒストグラム"""
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted((name, str(label)) for name, label in labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """ブロックの実行時間（秒）を記録する。デコレータとしても使える"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def collect(self):
+        """(ラベル, バケットごとの件数, 合計, 件数) のリストを返す"""
+        with self._lock:
+            return [(dict(key), list(series["buckets"]), series["sum"], series["count"])
+                    for key, series in self._series.items()]
+
+    def quantile(self, counts, q):
+        """バケットの件数から分位点を推定する（バケット内は線形補間）"""
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = upper
+        # 最大のバケットを超えた値は上限として扱う
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+        # しきい値を超えたクエリの直近の記録（メトリクスのページで表示する）
+        self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram(name, description, buckets)
+            return self._histograms[name]
+
+    def histograms(self):
+        with self._lock:
+            return list(self._histograms.values())
+
+    def render_prometheus(self):
+        """Prometheusのテキスト形式で全ヒストグラムを出力する"""
+        lines = []
+        for histogram in self.histograms():
+            lines.append(f"# HELP {histogram.name} {histogram.description}")
+            lines.append(f"# TYPE {histogram.name} histogram")
+            for labels, counts, total, count in histogram.collect():
+                cumulative = 0
+                for upper, bucket_count in zip(histogram.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{histogram.name}_bucket{_format_labels(labels, le=_format_value(upper))} {cumulative}")
+                lines.append(f"{histogram.name}_bucket{_format_labels(labels, le='+Inf')} {count}")
+                lines.append(f"{histogram.name}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{histogram.name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """メトリクスのページ用に、系列ごとの件数・平均・分位点をまとめて返す"""
+        rows = []
+        for histogram in self.histograms():
+            for labels, counts, total, count in histogram.collect():
+                rows.append({
+                    "metric": histogram.name,
+                    "labels": ", ".join(f"{name}={value}" for name, value in labels.items()),
+                    "count": count,
+                    "mean": total / count if count else None,
+                    "p50": histogram.quantile(counts, 0.5),
+                    "p95": histogram.quantile(counts, 0.95),
+                    "p99": histogram.quantile(counts, 0.99),
+                })
+        return rows
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(str(value))}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = MetricsRegistry()
+
+RERUN_SECONDS = metrics.histogram("chatbot_rerun_seconds", "Streamlitのスクリプト（main）1回の実行時間")
+DB_QUERY_SECONDS = metrics.histogram("chatbot_db_query_seconds", "SQL文の実行時間")
+DB_QUERY_ROWS = metrics.histogram("chatbot_db_query_rows", "SQL文が返した・更新した行数", ROW_BUCKETS)
+LLM_INIT_SECONDS = metrics.histogram("chatbot_llm_init_seconds", "LLMインスタンスの作成時間")
+LLM_TTFT_SECONDS = metrics.histogram("chatbot_llm_ttft_seconds", "ストリーム応答の最初のチャンクまでの時間")
+LLM_STREAM_SECONDS = metrics.histogram("chatbot_llm_stream_seconds", "ストリーム応答が終わるまでの時間")
+BCRYPT_SECONDS = metrics.histogram("chatbot_bcrypt_seconds", "パスワードのハッシュ化・照合の時間（ワーカーの待ち時間を含む）")
+SCHEDULER_WAIT_SECONDS = metrics.histogram("chatbot_scheduler_wait_seconds", "LLMへのリクエストが順番待ちをした時間")
+LLM_RETRY_DELAY_SECONDS = metrics.histogram("chatbot_llm_retry_delay_seconds", "LLMへのリクエストを再試行するまでに待った時間")
+
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|:\w+|\$\d+|\?")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SELECT_LIST = re.compile(r"\bSELECT\s+(DISTINCT\s+)?.+?\s+FROM\b", re.IGNORECASE | re.DOTALL)
+
+
+def fingerprint_statement(statement):
+    """SQL文からリテラルとプレースホルダを取り除き、同じ形のクエリを1つにまとめたキーにする
+
+    ORMのクエリは長い列の一覧から始まるため、SELECTの列は省略してWHERE以降が見えるようにする。
+    それでも長い文は切り詰め、切り詰めた文どうしが混ざらないよう元の文のハッシュを付ける。
+    """
+    normalized = _STRING_LITERAL.sub("?", statement)
+    normalized = _PLACEHOLDER.sub("?", normalized)
+    normalized = _NUMBER_LITERAL.sub("?", normalized)
+    normalized = _IN_LIST.sub("(?+)", normalized)
+    normalized = " ".join(normalized.split())
+    fingerprint = _SELECT_LIST.sub(lambda match: f"SELECT {match.group(1) or ''}… FROM", normalized)
+    if len(fingerprint) <= FINGERPRINT_MAX_LENGTH:
+        return fingerprint
+    digest = hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:8]
+    return f"{fingerprint[:FINGERPRINT_MAX_LENGTH]}… #{digest}"
+
+
+class _RowCountingCursor(sqlite3.Cursor):
+    # sqlite3はSELECTのrowcountを返さないため、取得した行数を数えてcloseのときに記録する
+    _metrics_labels = None
+    _metrics_rows = 0
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._metrics_rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._metrics_rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._metrics_rows += len(rows)
+        return rows
+
+    def close(self):
+        if self._metrics_labels is not None:
+            DB_QUERY_ROWS.observe(self._metrics_rows, **self._metrics_labels)
+            self._metrics_labels = None
+        super().close()
+
+
+class RowCountingConnection(sqlite3.Connection):
+    """SELECTで取得した行数を数えるカーソルを返すsqlite3の接続（connect_argsのfactoryに指定する）"""
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or _RowCountingCursor)
+
+
+def instrument_engine(engine, name):
+    """エンジンで実行されるSQL文の実行時間と行数を記録し、遅いクエリをログに出す"""
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_start", []).append(perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter() - conn.info["metrics_start"].pop()
+        labels = {"db": name, "statement": fingerprint_statement(statement)}
+        DB_QUERY_SECONDS.observe(elapsed, **labels)
+        if isinstance(cursor, _RowCountingCursor) and cursor.description is not None:
+            cursor._metrics_labels = labels
+            cursor._metrics_rows = 0
+        elif cursor.rowcount is not None and cursor.rowcount >= 0:
+            DB_QUERY_ROWS.observe(cursor.rowcount, **labels)
+        if SLOW_QUERY_SECONDS is not None and elapsed >= SLOW_QUERY_SECONDS:
+            metrics.slow_queries.append({"time": time(), "db": name, "seconds": elapsed, "statement": labels["statement"]})
+            logger.warning("遅いクエリ (%.3fs, %s): %s", elapsed, name, labels["statement"])
+
+    def handle_error(exception_context):
+        # 失敗した文のafter_cursor_executeは呼ばれないため、開始時刻を取り除く
+        connection = exception_context.connection
+        if connection is not None and connection.info.get("metrics_start"):
+            connection.info["metrics_start"].pop()
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(engine, "handle_error", handle_error)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # スクレイプのたびにアクセスログを出さない
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """/metricsを返すHTTPサーバーを別スレッドで起動する（プロセスで一度だけ）"""
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError:
+                # 再実行のたびに試さないよう、失敗したことを記録しておく
+                logger.warning("メトリクスのポート%sを開けませんでした", port, exc_info=True)
+                _server = False
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+        return _server or None
@@ -0,0 +1,54 @@
+# pages/metrics.py
+import streamlit as st
+
+from metrics import metrics
+from config import ADMIN_USERS
+
+
+def is_admin():
+    return st.session_state.get("logged_in", False) and st.session_state.get("username") in ADMIN_USERS
+
+
+def display_histograms():
+    """系列ごとの件数・平均・分位点を表示する（秒のメトリクスはミリ秒に換算する）"""
+    rows = []
+    for row in metrics.summary():
+        if row["metric"].endswith("_seconds"):
+            row = {**row, **{key: None if row[key] is None else row[key] * 1000 for key in ("mean", "p50", "p95", "p99")}}
+            row["unit"] = "ms"
+        else:
+            row["unit"] = ""
+        rows.append(row)
+    if not rows:
+        st.write("まだ記録されたメトリクスはありません。")
+        return
+    st.dataframe(rows, use_container_width=True)
+
+
+def display_slow_queries():
+    slow_queries = list(metrics.slow_queries)
+    if not slow_queries:
+        st.write("しきい値を超えたクエリはありません。")
+        return
+    st.dataframe([
+        {"seconds": query["seconds"], "db": query["db"], "statement": query["statement"]}
+        for query in reversed(slow_queries)
+    ], use_container_width=True)
+
+
+def main():
+    if not is_admin():
+        st.error("このページは管理者のみ表示できます。")
+        st.stop()
+    st.title("Metrics")
+    # ボタンを押すと再実行され、最新の値が表示される
+    st.button("更新")
+    st.subheader("ヒストグラム")
+    display_histograms()
+    st.subheader("遅いクエリ")
+    display_slow_queries()
+    with st.expander("Prometheus形式"):
+        st.code(metrics.render_prometheus(), language="text")
+
+
+main()
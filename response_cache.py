@@ -0,0 +1,203 @@
+# response_cache.py
+import hashlib
+import threading
+import unicodedata
+import zlib
+from time import time
+
+import numpy as np
+from sqlalchemy import Column, Integer, Float, String, Text, LargeBinary, delete, select
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from metrics import instrument_engine
+from config import (
+    RESPONSE_CACHE_URL, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_NEAR_DUPLICATE,
+    RESPONSE_CACHE_SIMILARITY, RESPONSE_CACHE_CANDIDATES,
+)
+
+VECTOR_DIM = 1024
+NGRAM_SIZE = 3
+EVICTION_INTERVAL = 100
+
+Base = declarative_base()
+
+class CachedResponse(Base):
+    __tablename__ = 'response_cache'
+
+    key = Column(String, primary_key=True)
+    context_key = Column(String, index=True, nullable=False)
+    input_text = Column(Text, nullable=False)
+    response = Column(Text, nullable=False)
+    vector = Column(LargeBinary, nullable=True)
+    created_at = Column(Float, nullable=False)
+    last_used_at = Column(Float, index=True, nullable=False)
+    hits = Column(Integer, nullable=False, default=0)
+
+
+def normalize_text(text):
+    """全角・半角や空白の違いを吸収した比較用の文字列にする"""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def hash_parts(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def hash_memory(messages):
+    """メモリのウィンドウを正規化してハッシュ化する"""
+    return hash_parts(*(f"{message.type}:{normalize_text(message.content)}" for message in messages))
+
+
+def text_vector(text, dim=VECTOR_DIM, n=NGRAM_SIZE):
+    """文字n-gramをハッシュしたL2正規化済みのベクトルを返す"""
+    normalized = normalize_text(text)
+    if len(normalized) < n:
+        ngrams = [normalized] if normalized else []
+    else:
+        ngrams = [normalized[i:i + n] for i in range(len(normalized) - n + 1)]
+    # プロセスごとに値が変わるhash()ではなく、安定したcrc32を使う
+    indices = np.fromiter((zlib.crc32(ngram.encode("utf-8")) for ngram in ngrams), dtype=np.uint32, count=len(ngrams))
+    vector = np.bincount(indices % dim, minlength=dim).astype(np.float32)
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+class ResponseCache:
+    """LLMの応答をSQLiteに保存する、TTLとLRUで上限を管理するキャッシュ
+
+    完全一致で見つからない場合、near_duplicateが有効なら同じ文脈の過去の入力と
+    文字n-gramベクトルのコサイン類似度で近い質問を探す。
+    """
+
+    def __init__(self, url=RESPONSE_CACHE_URL, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+                 near_duplicate=RESPONSE_CACHE_NEAR_DUPLICATE, similarity=RESPONSE_CACHE_SIMILARITY,
+                 candidates=RESPONSE_CACHE_CANDIDATES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.near_duplicate = near_duplicate
+        self.similarity = similarity
+        self.candidates = candidates
+        # WALモードやビジータイムアウトなどの設定はチャット履歴のエンジンと共通にする
+        from database import create_database_engine
+
+        self.engine = create_database_engine(url)
+        instrument_engine(self.engine, "response_cache")
+        self.Session = sessionmaker(bind=self.engine)
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        self._puts = 0
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def _session(self):
+        # テーブルはインポート時ではなく、最初に使うときに作成する
+        if not self._schema_ready:
+            with self._lock:
+                if not self._schema_ready:
+                    Base.metadata.create_all(self.engine)
+                    self._schema_ready = True
+        return self.Session()
+
+    def _keys(self, model_provider, model_name, temperature, system_message, memory_messages, input_text):
+        context_key = hash_parts(model_provider, model_name, temperature, system_message, hash_memory(memory_messages))
+        return context_key, hash_parts(context_key, normalize_text(input_text))
+
+    def get(self, model_provider, model_name, temperature, system_message, memory_messages, input_text):
+        """キャッシュされた応答を返す。見つからない場合はNoneを返す"""
+        context_key, key = self._keys(model_provider, model_name, temperature, system_message, memory_messages, input_text)
+        now = time()
+        session = self._session()
+        try:
+            entry = session.get(CachedResponse, key)
+            if entry is not None and now - entry.created_at > self.ttl:
+                session.delete(entry)
+                session.commit()
+                entry = None
+            near = False
+            if entry is None and self.near_duplicate:
+                entry = self._find_near_duplicate(session, context_key, input_text, now)
+                near = entry is not None
+            if entry is None:
+                self._count(miss=True)
+                return None
+            entry.last_used_at = now
+            entry.hits += 1
+            response = entry.response
+            session.commit()
+            self._count(near=near)
+            return response
+        finally:
+            session.close()
+
+    def _find_near_duplicate(self, session, context_key, input_text, now):
+        rows = session.query(CachedResponse).filter(
+            CachedResponse.context_key == context_key,
+            CachedResponse.vector.isnot(None),
+            CachedResponse.created_at >= now - self.ttl,
+        ).order_by(CachedResponse.last_used_at.desc()).limit(self.candidates).all()
+        if not rows:
+            return None
+        matrix = np.vstack([np.frombuffer(row.vector, dtype=np.float32) for row in rows])
+        scores = matrix @ text_vector(input_text)
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity:
+            return None
+        return rows[best]
+
+    def put(self, model_provider, model_name, temperature, system_message, memory_messages, input_text, response):
+        """応答をキャッシュに保存する"""
+        if not response:
+            return
+        context_key, key = self._keys(model_provider, model_name, temperature, system_message, memory_messages, input_text)
+        now = time()
+        vector = text_vector(input_text).tobytes() if self.near_duplicate else None
+        session = self._session()
+        try:
+            session.merge(CachedResponse(
+                key=key, context_key=context_key, input_text=input_text, response=response,
+                vector=vector, created_at=now, last_used_at=now, hits=0,
+            ))
+            session.commit()
+        finally:
+            session.close()
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """期限切れのエントリと、上限を超えた古いエントリを削除する"""
+        session = self._session()
+        try:
+            session.execute(delete(CachedResponse).where(CachedResponse.created_at < time() - self.ttl))
+            overflow = select(CachedResponse.key).order_by(CachedResponse.last_used_at.desc()).offset(self.max_entries)
+            session.execute(delete(CachedResponse).where(CachedResponse.key.in_(overflow)))
+            session.commit()
+        finally:
+            session.close()
+
+    def _count(self, miss=False, near=False):
+        with self._lock:
+            if miss:
+                self.misses += 1
+            elif near:
+                self.near_hits += 1
+            else:
+                self.hits += 1
+
+    def stats(self):
+        """キャッシュのヒット数とミス数を返す"""
+        with self._lock:
+            return {"hits": self.hits, "near_hits": self.near_hits, "misses": self.misses}
+
+
+response_cache = ResponseCache()
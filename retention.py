@@ -0,0 +1,126 @@
+# retention.py
+"""古い会話をアーカイブして削除し、データベースファイルを小さく保つ保持期間ジョブ
+
+使い方:
+    python retention.py --days 365 --archive-dir archive
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+from datetime import timedelta
+
+from sqlalchemy import or_
+
+from database import Conversation, Message, engine, session_scope, purge_conversations, current_time_jst, rebuild_search_index, init_db
+from config import RETENTION_DAYS, RETENTION_ARCHIVE_DIR, RETENTION_BATCH_SIZE, RETENTION_VACUUM_PAGES
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def find_expired_conversations(session, cutoff, limit):
+    """最終更新がcutoffより古い会話と、論理削除された会話を取得する"""
+    return session.query(Conversation).filter(or_(
+        Conversation.updated_at < cutoff,
+        Conversation.deleted_at.isnot(None),
+    )).order_by(Conversation.updated_at.asc()).limit(limit).all()
+
+
+def archive_conversations(session, conversations, archive_file):
+    """会話ごとに1行のJSONとしてメッセージと一緒に書き出す"""
+    conversation_ids = [conversation.id for conversation in conversations]
+    messages = {conversation_id: [] for conversation_id in conversation_ids}
+    query = session.query(Message).filter(
+        Message.conversation_id.in_(conversation_ids),
+    ).order_by(Message.conversation_id, Message.timestamp, Message.id)
+    for message in query.yield_per(1000):
+        messages[message.conversation_id].append({
+            "id": message.id,
+            "sender": message.sender,
+            "message": message.message,
+            "caption": message.caption,
+            "timestamp": _isoformat(message.timestamp),
+        })
+    for conversation in conversations:
+        record = {
+            "conversation_id": conversation.id,
+            "user_id": conversation.user_id,
+            "created_at": _isoformat(conversation.created_at),
+            "updated_at": _isoformat(conversation.updated_at),
+            "deleted_at": _isoformat(conversation.deleted_at),
+            "summary": conversation.summary,
+            "messages": messages[conversation.id],
+        }
+        archive_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def incremental_vacuum(pages=RETENTION_VACUUM_PAGES):
+    """SQLiteの空きページを解放する。auto_vacuumが無効なDBは一度だけVACUUMで切り替える"""
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        mode = connection.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+        if mode != 2:
+            connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            connection.exec_driver_sql("VACUUM")
+            # VACUUMでconversationsのrowidが変わるため、全文検索の索引を作り直す
+            rebuild_search_index()
+        else:
+            connection.exec_driver_sql(f"PRAGMA incremental_vacuum({int(pages)})")
+
+
+def run_retention(days=RETENTION_DAYS, archive_dir=RETENTION_ARCHIVE_DIR, batch_size=RETENTION_BATCH_SIZE, archive=True, vacuum_pages=RETENTION_VACUUM_PAGES):
+    """保持期間を過ぎた会話をアーカイブしてからバッチごとに削除し、削除した会話数を返す"""
+    cutoff = current_time_jst() - timedelta(days=days)
+    raw_file = archive_file = archive_path = None
+    if archive:
+        os.makedirs(archive_dir, exist_ok=True)
+        archive_path = os.path.join(archive_dir, f"chat_history-{current_time_jst():%Y%m%d-%H%M%S}.jsonl.gz")
+        raw_file = open(archive_path, "wb")
+        archive_file = io.TextIOWrapper(gzip.GzipFile(fileobj=raw_file, mode="wb"), encoding="utf-8")
+
+    purged = 0
+    try:
+        while True:
+            with session_scope() as session:
+                conversations = find_expired_conversations(session, cutoff, batch_size)
+                if not conversations:
+                    break
+                if archive_file is not None:
+                    archive_conversations(session, conversations, archive_file)
+                    # 削除をコミットする前にアーカイブをディスクに書き出す
+                    archive_file.flush()
+                    os.fsync(raw_file.fileno())
+                purge_conversations(session, [conversation.id for conversation in conversations])
+            purged += len(conversations)
+    finally:
+        if archive_file is not None:
+            archive_file.close()
+            raw_file.close()
+            if purged == 0:
+                os.remove(archive_path)
+
+    if vacuum_pages:
+        incremental_vacuum(vacuum_pages)
+    return purged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="保持期間を過ぎた会話をアーカイブして削除する")
+    parser.add_argument("--days", type=int, default=RETENTION_DAYS, help="保持する日数")
+    parser.add_argument("--archive-dir", default=RETENTION_ARCHIVE_DIR, help="アーカイブ（.jsonl.gz）の出力先")
+    parser.add_argument("--batch-size", type=int, default=RETENTION_BATCH_SIZE, help="1回のトランザクションで削除する会話数")
+    parser.add_argument("--no-archive", action="store_true", help="アーカイブせずに削除する")
+    parser.add_argument("--vacuum-pages", type=int, default=RETENTION_VACUUM_PAGES, help="incremental_vacuumで解放するページ数（0で無効）")
+    args = parser.parse_args()
+    init_db()
+    purged = run_retention(args.days, args.archive_dir, args.batch_size, not args.no_archive, args.vacuum_pages)
+    print(f"{purged}件の会話を削除しました。")
+
+
+if __name__ == "__main__":
+    main()
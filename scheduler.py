@@ -0,0 +1,220 @@
+# scheduler.py
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+from metrics import SCHEDULER_WAIT_SECONDS, LLM_RETRY_DELAY_SECONDS
+from config import (
+    SCHEDULER_MAX_CONCURRENCY, SCHEDULER_TOKENS_PER_MINUTE, SCHEDULER_LIMITS,
+    SCHEDULER_OUTPUT_TOKEN_ESTIMATE, RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+)
+
+# 待機中に順番やトークンの補充を確認し直す間隔（秒）
+POLL_INTERVAL = 0.5
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+RETRYABLE_ERROR_NAMES = {"APIConnectionError", "APITimeoutError", "ConnectError", "ConnectTimeout", "ReadTimeout", "RemoteProtocolError"}
+
+
+def status_code(error):
+    """SDKの例外からHTTPステータスコードを取り出す"""
+    code = getattr(error, "status_code", None)
+    if code is None:
+        code = getattr(getattr(error, "response", None), "status_code", None)
+    return code
+
+
+def is_retryable(error):
+    """レート制限・サーバーエラー・接続エラーなど、再試行すれば成功しうる例外かどうか"""
+    code = status_code(error)
+    if code is not None:
+        return code in RETRYABLE_STATUS_CODES or code >= 500
+    return type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+
+def retry_after(error):
+    """Retry-Afterヘッダーで指定された待ち時間（秒）を返す。ない場合はNoneを返す"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class Ticket:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.enqueued_at = monotonic()
+
+
+class RequestScheduler:
+    """1つのプロバイダ・モデルへのリクエストを、同時実行数と1分あたりのトークン数の上限内で順番に実行する
+
+    待っているリクエストは到着順に並び、先頭のリクエストだけが開始できる。
+    トークンはリクエストの開始時に見積もりで消費し、終了時に実際の使用量との差を戻す。
+    レート制限などで失敗した場合は、指数バックオフ（ジッター付き）で再試行し、その間は
+    後続のリクエストも開始させない。
+    """
+
+    def __init__(self, name, max_concurrency=SCHEDULER_MAX_CONCURRENCY, tokens_per_minute=SCHEDULER_TOKENS_PER_MINUTE,
+                 max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        self._waiting = deque()
+        self._active = 0
+        self._tokens = float(tokens_per_minute or 0)
+        self._refilled_at = monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self, now):
+        if self.tokens_per_minute:
+            elapsed = now - self._refilled_at
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+        self._refilled_at = now
+
+    def _wait_time(self, ticket, now):
+        # 先頭のticketが開始できるまでの秒数（0なら開始できる、Noneなら他のリクエストの終了待ち）
+        if self._waiting[0] is not ticket or self._active >= self.max_concurrency:
+            return None
+        if self._blocked_until > now:
+            return self._blocked_until - now
+        if self.tokens_per_minute and self._tokens < ticket.tokens:
+            return (ticket.tokens - self._tokens) * 60 / self.tokens_per_minute
+        return 0
+
+    def acquire(self, tokens, on_wait=None):
+        """順番が来るまで待ってticketを返す。待っている間はon_wait(順番)を順番が変わるたびに呼ぶ"""
+        if self.tokens_per_minute:
+            # 1分の上限を超える見積もりは、上限まで溜まれば開始できるようにする
+            tokens = min(tokens, self.tokens_per_minute)
+        ticket = Ticket(tokens)
+        reported = None
+        try:
+            with self._cond:
+                self._waiting.append(ticket)
+                while True:
+                    now = monotonic()
+                    self._refill(now)
+                    wait = self._wait_time(ticket, now)
+                    if wait == 0:
+                        self._waiting.popleft()
+                        self._active += 1
+                        self._tokens -= ticket.tokens
+                        # 次の先頭のリクエストも開始できるか確認させる
+                        self._cond.notify_all()
+                        break
+                    position = self._waiting.index(ticket) + 1
+                    if on_wait is not None and position != reported:
+                        reported = position
+                        on_wait(position)
+                    self._cond.wait(POLL_INTERVAL if wait is None else min(wait, POLL_INTERVAL))
+        except BaseException:
+            # 待っている間に中断された場合（Streamlitの再実行など）は列から外す
+            with self._cond:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    self._cond.notify_all()
+            raise
+        SCHEDULER_WAIT_SECONDS.observe(monotonic() - ticket.enqueued_at, scheduler=self.name)
+        return ticket
+
+    def release(self, ticket, used_tokens=None):
+        """実行を終え、見積もりと実際の使用量の差をトークンの残りに戻す"""
+        with self._cond:
+            self._active -= 1
+            if self.tokens_per_minute and used_tokens is not None:
+                self._tokens = min(self.tokens_per_minute, self._tokens + ticket.tokens - used_tokens)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, tokens, on_wait=None):
+        ticket = self.acquire(tokens, on_wait)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket, getattr(ticket, "used_tokens", None))
+
+    def backoff(self, attempt, error=None):
+        """attempt回目の再試行までの待ち時間。Retry-Afterがあればそれ以上待つ"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        server_delay = retry_after(error) if error is not None else None
+        if server_delay is not None:
+            delay = max(delay, min(server_delay, self.max_delay))
+        return delay
+
+    def _retry(self, attempt, error):
+        # 再試行しない例外はそのまま送出する。再試行する場合は待つ間、後続のリクエストも開始させない
+        if attempt + 1 >= self.max_attempts or not is_retryable(error):
+            raise error
+        delay = self.backoff(attempt, error)
+        LLM_RETRY_DELAY_SECONDS.observe(delay, scheduler=self.name, error=status_code(error) or type(error).__name__)
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, monotonic() + delay)
+        sleep(delay)
+
+    def stream(self, create_stream, input_tokens, on_wait=None):
+        """順番を待ってからcreate_stream()のチャンクを返すジェネレータ
+
+        最初のチャンクを返す前に再試行できる例外が起きた場合だけ再試行する
+        （途中まで表示した応答を重複させないため）。
+        終了時には、入力トークン数と受け取ったチャンク数を実際の使用量としてトークンの残りを補正する。
+        """
+        with self.slot(input_tokens + SCHEDULER_OUTPUT_TOKEN_ESTIMATE, on_wait) as ticket:
+            attempt = 0
+            chunks = 0
+            while True:
+                try:
+                    for chunk in create_stream():
+                        chunks += 1
+                        yield chunk
+                    break
+                except Exception as error:
+                    if chunks:
+                        raise
+                    self._retry(attempt, error)
+                    attempt += 1
+            ticket.used_tokens = input_tokens + chunks
+
+    def call(self, func, input_tokens, output_tokens=None):
+        """順番を待ってからfunc()を呼び、再試行できる例外の場合は再試行する
+
+        output_tokensを指定した場合は、output_tokens(結果)を応答のトークン数としてトークンの残りを補正する。
+        """
+        with self.slot(input_tokens + SCHEDULER_OUTPUT_TOKEN_ESTIMATE) as ticket:
+            attempt = 0
+            while True:
+                try:
+                    result = func()
+                    if output_tokens is not None:
+                        ticket.used_tokens = input_tokens + output_tokens(result)
+                    return result
+                except Exception as error:
+                    self._retry(attempt, error)
+                    attempt += 1
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(model_provider, model_name):
+    """プロバイダ・モデルごとのプロセス共有のスケジューラを返す"""
+    name = f"{model_provider}/{model_name}"
+    with _schedulers_lock:
+        scheduler = _schedulers.get(name)
+        if scheduler is None:
+            limits = SCHEDULER_LIMITS.get(name, {})
+            scheduler = _schedulers[name] = RequestScheduler(
+                name,
+                max_concurrency=limits.get("max_concurrency", SCHEDULER_MAX_CONCURRENCY),
+                tokens_per_minute=limits.get("tokens_per_minute", SCHEDULER_TOKENS_PER_MINUTE),
+            )
+        return scheduler
@@ -0,0 +1,224 @@
+# state_store.py
+"""複数のStreamlitプロセスで共有する状態（会話メモリ・ログインセッションなど）の保存先
+
+STATE_STORE_URLで実装を選ぶ:
+    memory://                 プロセス内の辞書（プロセス間では共有しない）
+    sqlite:///state.db など   SQLAlchemyのURL（同じマシンの複数プロセスで共有できる）
+    redis://localhost:6379/0  Redis互換のサーバー（redisパッケージが必要）
+
+値はJSONにできるものを保存し、ttl（秒）を指定した場合はその時間が経つと消える。
+"""
+import json
+import threading
+from time import time
+
+from sqlalchemy import Column, Float, String, Text, delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from metrics import instrument_engine
+from config import STATE_STORE_URL
+
+EVICTION_INTERVAL = 100
+
+Base = declarative_base()
+
+
+class StateEntry(Base):
+    __tablename__ = 'state_store'
+
+    key = Column(String, primary_key=True)
+    value = Column(Text, nullable=False)
+    expires_at = Column(Float, index=True, nullable=True)
+
+
+class StateStore:
+    """状態の保存先のインターフェース"""
+
+    def get(self, key):
+        """キーの値を返す。ない場合・期限切れの場合はNoneを返す"""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        """キーに値を保存する（既にあれば上書きする）"""
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=None):
+        """キーがない場合だけ値を保存し、保存されている値を返す（複数プロセスで1つの値を決めるのに使う）"""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryStateStore(StateStore):
+    """プロセス内の辞書に保存する実装"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at = entry[1]
+        if expires_at is not None and expires_at <= now:
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._get(key, time())
+        # 呼び出し元が書き換えても保存した値に影響しないよう、他の実装と同じくJSONから復元する
+        return json.loads(entry[0]) if entry is not None else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (json.dumps(value, ensure_ascii=False), time() + ttl if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        now = time()
+        with self._lock:
+            entry = self._get(key, now)
+            if entry is None:
+                entry = self._entries[key] = (json.dumps(value, ensure_ascii=False), now + ttl if ttl else None)
+        return json.loads(entry[0])
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SQLStateStore(StateStore):
+    """SQLAlchemyのデータベースのテーブルに保存する実装
+
+    SQLiteの場合はチャット履歴と同じくWALモードで開くため、同じファイルを複数のプロセスから読み書きできる。
+    期限切れの行は読み込み時と、一定回数の書き込みごとにまとめて削除する。
+    """
+
+    def __init__(self, url):
+        # WALモードなどの設定はチャット履歴のエンジンと共通にする
+        from database import create_database_engine
+
+        self.engine = create_database_engine(url)
+        instrument_engine(self.engine, "state_store")
+        self.Session = sessionmaker(bind=self.engine)
+        self._lock = threading.Lock()
+        self._schema_ready = False
+        self._writes = 0
+
+    def _session(self):
+        # テーブルはインポート時ではなく、最初に使うときに作成する
+        if not self._schema_ready:
+            with self._lock:
+                if not self._schema_ready:
+                    Base.metadata.create_all(self.engine)
+                    self._schema_ready = True
+        return self.Session()
+
+    def get(self, key):
+        session = self._session()
+        try:
+            entry = session.get(StateEntry, key)
+            if entry is None or (entry.expires_at is not None and entry.expires_at <= time()):
+                return None
+            return json.loads(entry.value)
+        finally:
+            session.close()
+
+    def set(self, key, value, ttl=None):
+        session = self._session()
+        try:
+            session.merge(StateEntry(key=key, value=json.dumps(value, ensure_ascii=False), expires_at=time() + ttl if ttl else None))
+            session.commit()
+        finally:
+            session.close()
+        self._count_write()
+
+    def add(self, key, value, ttl=None):
+        now = time()
+        session = self._session()
+        try:
+            # 期限切れの行が残っていれば先に消す
+            session.execute(delete(StateEntry).where(StateEntry.key == key, StateEntry.expires_at <= now))
+            session.add(StateEntry(key=key, value=json.dumps(value, ensure_ascii=False), expires_at=now + ttl if ttl else None))
+            try:
+                session.commit()
+                return value
+            except IntegrityError:
+                # 他のプロセスが先に保存した値を使う
+                session.rollback()
+        finally:
+            session.close()
+        return self.get(key)
+
+    def delete(self, key):
+        session = self._session()
+        try:
+            session.execute(delete(StateEntry).where(StateEntry.key == key))
+            session.commit()
+        finally:
+            session.close()
+
+    def _count_write(self):
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """期限切れの行を削除する"""
+        session = self._session()
+        try:
+            session.execute(delete(StateEntry).where(StateEntry.expires_at <= time()))
+            session.commit()
+        finally:
+            session.close()
+
+
+class RedisStateStore(StateStore):
+    """Redis互換のサーバーに保存する実装（期限切れのキーはサーバーが削除する）
+
+    clientにredis.Redisと同じインターフェースのクライアント（fakeredisなど）を渡すこともできる。
+    """
+
+    def __init__(self, url=None, client=None, prefix="chatbot:"):
+        if client is None:
+            # redisパッケージはRedisを使う場合にだけ必要
+            import redis
+
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), px=int(ttl * 1000) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        if self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), px=int(ttl * 1000) if ttl else None, nx=True):
+            return value
+        return self.get(key)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def create_state_store(url=STATE_STORE_URL):
+    """URLのスキームに応じた状態の保存先を作成する"""
+    scheme = url.split("://", 1)[0].split("+", 1)[0]
+    if scheme == "memory":
+        return MemoryStateStore()
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisStateStore(url)
+    return SQLStateStore(url)
+
+
+state_store = create_state_store()
@@ -0,0 +1,134 @@
+# streaming.py
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from time import perf_counter
+
+from tokenizer import count_tokens
+
+STREAM_MAX_FLUSHES_PER_SEC = 20
+STREAM_FLUSH_BYTES = 2048
+CURSOR = "▌"
+
+
+class StreamRenderer:
+    """ストリーミング応答をまとめて描画し、TTFTとトークン速度を計測するクラス
+
+    チャンクはStringIOに追記し、前回の描画から一定時間が経つか未描画のバイト数が
+    上限を超えたときだけ画面を更新する。
+    """
+
+    def __init__(self, area, max_flushes_per_sec=STREAM_MAX_FLUSHES_PER_SEC, flush_bytes=STREAM_FLUSH_BYTES, start_time=None):
+        self.area = area
+        self.flush_interval = 1 / max_flushes_per_sec
+        self.flush_bytes = flush_bytes
+        self.buffer = StringIO()
+        self.start_time = start_time if start_time is not None else perf_counter()
+        self.first_token_time = None
+        self.end_time = None
+        self.tokens = 0
+        self._pending_bytes = 0
+        self._last_flush = self.start_time
+
+    def write(self, content):
+        """チャンクを追加し、必要であれば画面を更新する"""
+        if not content:
+            return
+        now = perf_counter()
+        if self.first_token_time is None:
+            self.first_token_time = now
+        self.buffer.write(content)
+        self._pending_bytes += len(content)
+        if now - self._last_flush >= self.flush_interval or self._pending_bytes >= self.flush_bytes:
+            self._flush(now, CURSOR)
+
+    def _flush(self, now, suffix=""):
+        self.area.write(self.buffer.getvalue() + suffix)
+        self._pending_bytes = 0
+        self._last_flush = now
+
+    def close(self):
+        """最終的なテキストを描画して返す
+
+        チャンクには複数のトークンが含まれうるため、トークン数は最後に本文から数える。
+        """
+        self.end_time = perf_counter()
+        self._flush(self.end_time)
+        text = self.buffer.getvalue()
+        self.tokens = count_tokens(text)
+        return text
+
+    def consume(self, chunks):
+        """チャンクのイテレータを最後まで描画してテキストを返す"""
+        for chunk in chunks:
+            self.write(chunk.content)
+        return self.close()
+
+    @property
+    def elapsed(self):
+        end_time = self.end_time if self.end_time is not None else perf_counter()
+        return end_time - self.start_time
+
+    @property
+    def ttft(self):
+        if self.first_token_time is None:
+            return None
+        return self.first_token_time - self.start_time
+
+    @property
+    def tokens_per_sec(self):
+        # 最初のトークンが届いてからの生成速度
+        if self.first_token_time is None or self.end_time is None:
+            return None
+        duration = self.end_time - self.first_token_time
+        if duration <= 0:
+            return None
+        return self.tokens / duration
+
+    def stats(self, cached=False):
+        """メッセージと一緒に保存する計測値（キャッシュから再生した応答の生成速度は記録しない）"""
+        return {
+            "ttft": self.ttft,
+            "output_tokens": self.tokens,
+            "tokens_per_sec": None if cached else self.tokens_per_sec,
+        }
+
+    def caption(self, model_name, cached=False):
+        stats = self.stats(cached)
+        parts = [f"Time: {self.elapsed:.2f}s"]
+        if cached:
+            parts.append("Cached")
+        if stats["ttft"] is not None:
+            parts.append(f"TTFT: {stats['ttft']:.2f}s")
+        parts.append(f"Tokens: {stats['output_tokens']}")
+        if stats["tokens_per_sec"] is not None:
+            parts.append(f"{stats['tokens_per_sec']:.1f} tokens/s")
+        parts.append(f"Model: {model_name}")
+        return ", ".join(parts)
+
+
+def stream_concurrently(llms, input_text):
+    """複数のLLMに同じ入力を並行して送り、(インデックス, チャンクの内容, 例外) を届いた順に返す
+
+    各LLMの応答が終わると内容がNoneの要素を返す。失敗した場合は例外を一緒に返す。
+    """
+    results = queue.Queue()
+
+    def worker(index, llm):
+        try:
+            for chunk in llm.stream(input_text):
+                results.put((index, chunk.content, None))
+        except Exception as error:
+            results.put((index, None, error))
+            return
+        results.put((index, None, None))
+
+    with ThreadPoolExecutor(max_workers=max(len(llms), 1), thread_name_prefix="compare") as executor:
+        for index, llm in enumerate(llms):
+            executor.submit(worker, index, llm)
+        remaining = len(llms)
+        while remaining:
+            index, content, error = results.get()
+            if content is None:
+                remaining -= 1
+            yield index, content, error
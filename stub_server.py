@@ -0,0 +1,165 @@
+# stub_server.py
+"""レート制限と応答の遅延を再現する、OpenAI互換のローカルのスタブサーバー
+
+スケジューラの順番待ちや再試行を、実際のAPIを使わずに確かめるために使う。
+
+使い方:
+    python stub_server.py --port 8787 --requests-per-minute 10 --max-concurrency 2 --error-rate 0.1
+    OPENAI_BASE_URL=http://127.0.0.1:8787/v1 OPENAI_API_KEY=dummy streamlit run app.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_WORDS = ["データ", "会話", "応答", "モデル", "検索", "要約", "履歴", "設定", "処理", "結果", "速度", "計測"]
+
+
+class StubState:
+    """直近の受付時刻と実行中のリクエスト数から、429を返すかどうかを決める"""
+
+    def __init__(self, args):
+        self.args = args
+        self.accepted = deque()
+        self.active = 0
+        self.lock = threading.Lock()
+        self.stats = {"accepted": 0, "rate_limited": 0, "errors": 0}
+
+    def admit(self):
+        """受け付ける場合はNone、断る場合は (ステータス, Retry-After秒) を返す"""
+        now = time.monotonic()
+        with self.lock:
+            while self.accepted and now - self.accepted[0] >= self.args.window:
+                self.accepted.popleft()
+            if self.args.requests_per_minute and len(self.accepted) >= self.args.requests_per_minute:
+                self.stats["rate_limited"] += 1
+                return 429, self.args.window - (now - self.accepted[0])
+            if self.args.max_concurrency and self.active >= self.args.max_concurrency:
+                self.stats["rate_limited"] += 1
+                return 429, 1.0
+            if random.random() < self.args.error_rate:
+                self.stats["errors"] += 1
+                return 500, None
+            self.accepted.append(now)
+            self.active += 1
+            self.stats["accepted"] += 1
+            return None
+
+    def finish(self):
+        with self.lock:
+            self.active -= 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+        rejected = self.state.admit()
+        if rejected is not None:
+            status, retry_after = rejected
+            headers = {"Retry-After": f"{retry_after:.2f}"} if retry_after is not None else {}
+            error_type = "rate_limit_error" if status == 429 else "server_error"
+            self._send_json(status, {"error": {"message": f"stub {error_type}", "type": error_type}}, headers)
+            return
+        try:
+            tokens = [random.choice(_WORDS) + ("。" if i % 8 == 7 else "、") for i in range(self.state.args.response_tokens)]
+            time.sleep(self.state.args.ttft)
+            if request.get("stream"):
+                self._stream(request, tokens)
+            else:
+                time.sleep(len(tokens) / self.state.args.tokens_per_sec)
+                self._send_json(200, self._completion(request, "".join(tokens)))
+        finally:
+            self.state.finish()
+
+    def _completion(self, request, content):
+        return {
+            "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()), "model": request.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    def _stream(self, request, tokens):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        interval = 1 / self.state.args.tokens_per_sec
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(interval)
+            self._send_event({"index": 0, "delta": {"role": "assistant", "content": token} if i == 0 else {"content": token}, "finish_reason": None}, request)
+        self._send_event({"index": 0, "delta": {}, "finish_reason": "stop"}, request)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def _send_event(self, choice, request):
+        chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                 "model": request.get("model"), "choices": [choice]}
+        self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+
+def start_stub_server(args):
+    """スタブサーバーを別スレッドで起動して、サーバーを返す"""
+    handler = type("Handler", (StubHandler,), {"state": StubState(args)})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="レート制限と遅延を再現するOpenAI互換のスタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--ttft", type=float, default=0.3, help="最初のトークンまでの秒数")
+    parser.add_argument("--tokens-per-sec", type=float, default=30.0, help="1秒あたりに返すトークン数")
+    parser.add_argument("--response-tokens", type=int, default=40, help="応答のトークン数")
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="window秒あたりに受け付けるリクエスト数（0で無制限）")
+    parser.add_argument("--window", type=float, default=60.0, help="requests-per-minuteを数える期間（秒）")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="同時に処理するリクエスト数（0で無制限）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500を返す割合")
+    parser.add_argument("--verbose", action="store_true", help="アクセスログを出す")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    server = start_stub_server(args)
+    print(f"http://{args.host}:{args.port}/v1 で待ち受けています（Ctrl+Cで終了）")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stats = server.RequestHandlerClass.state.stats
+        print(f"受付 {stats['accepted']}件 / 429 {stats['rate_limited']}件 / 500 {stats['errors']}件")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# summarizer.py
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+from llm import summarize, update_rolling_summary
+from database import get_conversation, load_recent_messages, load_messages_outside_budget, save_summary, save_rolling_summary
+from config import (
+    SUMMARY_MAX_WORKERS, SUMMARY_MIN_NEW_MESSAGES, SUMMARY_BATCH_SIZE, SUMMARY_BATCH_INTERVAL, SUMMARY_CONTEXT_MESSAGES,
+    SUMMARY_MODELS, ROLLING_SUMMARY_MAX_TOKENS, MEMORY_TOKEN_BUDGET, MODEL_MEMORY_TOKEN_BUDGETS,
+)
+
+logger = logging.getLogger(__name__)
+
+# どのモデルでもプロンプトに含まれないメッセージが出ないよう、最も小さい予算に要約の分の余裕を見て要約に取り込む
+FOLD_TOKEN_BUDGET = min([MEMORY_TOKEN_BUDGET, *MODEL_MEMORY_TOKEN_BUDGETS.values()]) - ROLLING_SUMMARY_MAX_TOKENS
+
+
+def format_messages(messages):
+    """要約用に会話を「送信者: 本文」の形式のテキストにする"""
+    return "\n".join(f"{message['sender']}: {message['message']}" for message in messages)
+
+
+def summary_llm_options(model_provider, api_key):
+    """要約に使うLLMの引数（プロバイダ・モデル・APIキー）を返す"""
+    api_key_option = "openai_api_key" if model_provider == "OpenAI" else "anthropic_api_key"
+    return {"model_provider": model_provider, "model_name": SUMMARY_MODELS[model_provider], api_key_option: api_key}
+
+
+class SummarizationService:
+    """会話の要約をリクエストの処理とは別のスレッドで作成するサービス
+
+    ジョブは会話IDで重複を除いてキューに積まれ、一定間隔でまとめてワーカープールに渡される。
+    前回の要約からmin_new_messages件以上メッセージが増えた会話だけを要約し直す。
+    あわせて、最も小さいモデルのトークン予算からあふれたメッセージをローリング要約に取り込む。
+    """
+
+    def __init__(self, max_workers=SUMMARY_MAX_WORKERS, min_new_messages=SUMMARY_MIN_NEW_MESSAGES,
+                 batch_size=SUMMARY_BATCH_SIZE, batch_interval=SUMMARY_BATCH_INTERVAL):
+        self.max_workers = max_workers
+        self.min_new_messages = min_new_messages
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._pending = OrderedDict()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._executor = None
+        self._dispatcher = None
+
+    def submit(self, conversation_id, model_provider, api_key):
+        """会話の要約ジョブを、会話で使っているプロバイダで登録する。既に待機中・実行中の会話は登録しない"""
+        if model_provider not in SUMMARY_MODELS or not api_key:
+            return False
+        with self._lock:
+            if self._stopped:
+                return False
+            self._start()
+            if conversation_id in self._in_flight:
+                return False
+            # 待機中の場合はプロバイダとAPIキーだけ最新のものに差し替える
+            is_new = conversation_id not in self._pending
+            self._pending[conversation_id] = (model_provider, api_key)
+        self._wakeup.set()
+        return is_new
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending) + len(self._in_flight)
+
+    def _start(self):
+        # 最初のジョブが登録されたときにスレッドを起動する
+        if self._dispatcher is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="summarizer")
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="summarizer-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def _dispatch_loop(self):
+        while True:
+            self._wakeup.wait()
+            # 短時間に続けて登録されたジョブをまとめて処理する
+            if not self._stopped:
+                sleep(self.batch_interval)
+            with self._lock:
+                batch = []
+                while self._pending and len(batch) < self.batch_size:
+                    batch.append(self._pending.popitem(last=False))
+                self._in_flight.update(conversation_id for conversation_id, _ in batch)
+                if not self._pending and not self._stopped:
+                    self._wakeup.clear()
+                stopped = self._stopped
+            for conversation_id, credentials in batch:
+                self._submit(conversation_id, credentials)
+            if stopped and not batch:
+                return
+
+    def _submit(self, conversation_id, credentials):
+        """ジョブをワーカープールに渡す
+
+        atexitで呼ばれるshutdown()より先にconcurrent.futuresがワーカープールを閉じるため、
+        インタープリタの終了処理中はsubmit()がRuntimeErrorになる。その場合は待機中のジョブを
+        失わないよう、ディスパッチャのスレッドでそのまま処理する。
+        """
+        try:
+            future = self._executor.submit(self._summarize, conversation_id, credentials)
+        except RuntimeError:
+            self._summarize(conversation_id, credentials)
+            self._finish(conversation_id)
+            return
+        future.add_done_callback(lambda _: self._finish(conversation_id))
+
+    def _finish(self, conversation_id):
+        with self._lock:
+            self._in_flight.discard(conversation_id)
+
+    def needs_summary(self, conversation):
+        """前回の要約から十分にメッセージが増えているかを判定する"""
+        if conversation is None:
+            return False
+        if not conversation.summary:
+            return True
+        summarized_count = conversation.summarized_count or 0
+        return conversation.message_count - summarized_count >= self.min_new_messages
+
+    def _summarize(self, conversation_id, credentials):
+        try:
+            conversation = get_conversation(conversation_id)
+            if conversation is None:
+                return
+            llm_options = summary_llm_options(*credentials)
+            self._fold_rolling_summary(conversation, llm_options)
+            if not self.needs_summary(conversation):
+                return
+            messages = load_recent_messages(conversation_id, SUMMARY_CONTEXT_MESSAGES)
+            summary = summarize(format_messages(messages), **llm_options)
+            save_summary(summary, conversation_id, conversation.message_count)
+        except Exception:
+            logger.exception("会話の要約に失敗しました: %s", conversation_id)
+
+    def _fold_rolling_summary(self, conversation, llm_options):
+        # 最も小さいモデルの予算からあふれたメッセージをローリング要約に取り込む
+        until_id = conversation.rolling_summary_until_id or 0
+        overflow = load_messages_outside_budget(conversation.id, FOLD_TOKEN_BUDGET, until_id)
+        if not overflow:
+            return
+        rolling_summary = update_rolling_summary(conversation.rolling_summary, format_messages(overflow), **llm_options)
+        save_rolling_summary(conversation.id, rolling_summary, overflow[-1]["id"])
+
+    def shutdown(self, wait=True):
+        """待機中のジョブを処理してからワーカーを停止する"""
+        with self._lock:
+            self._stopped = True
+            dispatcher = self._dispatcher
+        self._wakeup.set()
+        if dispatcher is not None:
+            dispatcher.join()
+            self._executor.shutdown(wait=wait)
+
+
+summarizer = SummarizationService()
+atexit.register(summarizer.shutdown)
@@ -0,0 +1,45 @@
+# tokenizer.py
+from functools import lru_cache
+
+ENCODING_NAME = "cl100k_base"
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    # tiktokenが使えない環境では概算に切り替える
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception:
+        return None
+
+
+def estimate_tokens(text):
+    """トークナイザを使わずにトークン数を概算する（ASCIIは4文字、それ以外は1文字を1トークンとみなす）"""
+    ascii_chars = sum(1 for char in text if char.isascii())
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def count_tokens(text):
+    """テキストのトークン数を数える"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text, max_tokens):
+    """テキストをmax_tokensトークン以内に収まるよう末尾から切り詰める"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    # 収まる最長の先頭部分を二分探索する（マルチバイト文字の途中で切らないよう文字単位で探す）
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low]
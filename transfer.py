@@ -0,0 +1,229 @@
+# transfer.py
+"""メッセージのストリーミングでのエクスポート・インポート
+
+一定の行数ずつ読み書きするため、データベースの大きさに関わらずメモリ使用量は一定になる。
+形式は出力先の拡張子で決まる（.jsonl / .jsonl.gz / .parquet / .arrow）。
+
+使い方:
+    python transfer.py export backup.jsonl.gz --user-id 1 --from 2024-01-01 --to 2024-12-31
+    python transfer.py import backup.jsonl.gz
+"""
+import argparse
+import gzip
+import json
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import bindparam, case, insert, select, update
+
+from database import engine, Message, Conversation, iter_messages, init_db
+from tokenizer import count_tokens
+from config import EXPORT_BATCH_SIZE
+
+# エクスポートする列（インポートではidを採番し直す）
+COLUMNS = [column.name for column in Message.__table__.columns]
+DATETIME_COLUMNS = {"timestamp"}
+
+
+def detect_format(path):
+    """ファイル名から (形式, gzip圧縮するかどうか) を返す"""
+    if path.endswith(".parquet"):
+        return "parquet", False
+    if path.endswith((".arrow", ".feather")):
+        return "arrow", False
+    if path.endswith(".gz"):
+        return "jsonl", True
+    return "jsonl", False
+
+
+def _batches(rows, batch_size):
+    rows = iter(rows)
+    while batch := list(islice(rows, batch_size)):
+        yield batch
+
+
+def _arrow_schema():
+    import pyarrow as pa
+
+    types = {
+        "id": pa.int64(), "ttft": pa.float64(), "tokens_per_sec": pa.float64(),
+        "output_tokens": pa.int64(), "token_count": pa.int64(), "timestamp": pa.timestamp("us"),
+    }
+    return pa.schema([(name, types.get(name, pa.string())) for name in COLUMNS])
+
+
+def _write_jsonl(batches, path, compress):
+    count = 0
+    opener = gzip.open if compress else open
+    with opener(path, "wt", encoding="utf-8") as file:
+        for batch in batches:
+            for row in batch:
+                record = {name: row[name].isoformat() if name in DATETIME_COLUMNS and row[name] is not None else row[name]
+                          for name in COLUMNS}
+                file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += len(batch)
+    return count
+
+
+def _write_arrow(batches, path, file_format):
+    # pyarrowはParquet・Arrowで出力する場合にだけ必要
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema()
+    count = 0
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(path, schema)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+    try:
+        for batch in batches:
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+            count += len(batch)
+    finally:
+        writer.close()
+    return count
+
+
+def export_messages(path, user_id=None, date_from=None, date_to=None, batch_size=EXPORT_BATCH_SIZE, file_format=None, compress=None):
+    """メッセージをbatch_size行ずつ読み込んでファイルに書き出し、書き出した件数を返す"""
+    detected_format, detected_compress = detect_format(path)
+    file_format = file_format or detected_format
+    compress = detected_compress if compress is None else compress
+    batches = _batches(iter_messages(user_id, date_from, date_to, batch_size), batch_size)
+    if file_format == "jsonl":
+        return _write_jsonl(batches, path, compress)
+    return _write_arrow(batches, path, file_format)
+
+
+def _read_jsonl(path, compress, batch_size):
+    opener = gzip.open if compress else open
+    with opener(path, "rt", encoding="utf-8") as file:
+        records = (json.loads(line) for line in file if line.strip())
+        for batch in _batches(records, batch_size):
+            for record in batch:
+                for name in DATETIME_COLUMNS:
+                    if record.get(name):
+                        record[name] = datetime.fromisoformat(record[name])
+            yield batch
+
+
+def _read_arrow(path, file_format, batch_size):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if file_format == "parquet":
+        for record_batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield record_batch.to_pylist()
+        return
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for index in range(reader.num_record_batches):
+            # 書き出したときのバッチがbatch_sizeより大きい場合は分けて返す
+            yield from _batches(reader.get_batch(index).to_pylist(), batch_size)
+
+
+def _update_conversations(connection, rows):
+    """インポートしたメッセージの会話の集計行を、バッチ単位でまとめて更新・作成する"""
+    aggregates = {}
+    for row in rows:
+        aggregate = aggregates.get(row["conversation_id"])
+        if aggregate is None:
+            aggregates[row["conversation_id"]] = {
+                "conversation_id": row["conversation_id"], "user_id": row["user_id"],
+                "first": row["timestamp"], "last": row["timestamp"], "count": 1,
+            }
+            continue
+        aggregate["first"] = min(aggregate["first"], row["timestamp"])
+        aggregate["last"] = max(aggregate["last"], row["timestamp"])
+        aggregate["count"] += 1
+
+    existing = set(connection.execute(
+        select(Conversation.id).where(Conversation.id.in_(list(aggregates)))
+    ).scalars())
+    updates = [aggregate for conversation_id, aggregate in aggregates.items() if conversation_id in existing]
+    if updates:
+        connection.execute(
+            update(Conversation).where(Conversation.id == bindparam("conversation_id")).values(
+                created_at=case((Conversation.created_at > bindparam("first"), bindparam("first")), else_=Conversation.created_at),
+                updated_at=case((Conversation.updated_at < bindparam("last"), bindparam("last")), else_=Conversation.updated_at),
+                message_count=Conversation.message_count + bindparam("count"),
+            ),
+            updates,
+        )
+    inserts = [
+        {"id": aggregate["conversation_id"], "user_id": aggregate["user_id"], "created_at": aggregate["first"],
+         "updated_at": aggregate["last"], "message_count": aggregate["count"]}
+        for conversation_id, aggregate in aggregates.items() if conversation_id not in existing
+    ]
+    if inserts:
+        connection.execute(insert(Conversation.__table__), inserts)
+
+
+def import_messages(path, batch_size=EXPORT_BATCH_SIZE, file_format=None, compress=None):
+    """ファイルのメッセージをbatch_size行ずつ一括挿入し、挿入した件数を返す
+
+    メッセージのidは採番し直し、会話の集計行（conversations）も同じトランザクションで更新する。
+    """
+    detected_format, detected_compress = detect_format(path)
+    file_format = file_format or detected_format
+    compress = detected_compress if compress is None else compress
+    if file_format == "jsonl":
+        batches = _read_jsonl(path, compress, batch_size)
+    else:
+        batches = _read_arrow(path, file_format, batch_size)
+
+    count = 0
+    for batch in batches:
+        rows = []
+        for record in batch:
+            row = {name: record.get(name) for name in COLUMNS if name != "id"}
+            if row["token_count"] is None:
+                row["token_count"] = count_tokens(row["message"])
+            rows.append(row)
+        with engine.begin() as connection:
+            connection.execute(insert(Message.__table__), rows)
+            _update_conversations(connection, rows)
+        count += len(rows)
+    return count
+
+
+def _parse_date(value):
+    return datetime.fromisoformat(value)
+
+
+def _parse_end_date(value):
+    # 日付だけの指定はその日の終わりまでを含める
+    parsed = datetime.fromisoformat(value)
+    if "T" not in value and " " not in value:
+        parsed = datetime.combine(parsed.date(), datetime.max.time())
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="メッセージをストリーミングでエクスポート・インポートする")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="メッセージをファイルに書き出す")
+    export_parser.add_argument("path", help="出力先（.jsonl / .jsonl.gz / .parquet / .arrow）")
+    export_parser.add_argument("--user-id", help="このユーザーのメッセージだけを書き出す")
+    export_parser.add_argument("--from", dest="date_from", type=_parse_date, help="この日時以降のメッセージだけを書き出す")
+    export_parser.add_argument("--to", dest="date_to", type=_parse_end_date, help="この日時以前のメッセージだけを書き出す")
+    export_parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE, help="1回に読み込む行数")
+
+    import_parser = subparsers.add_parser("import", help="ファイルのメッセージを取り込む")
+    import_parser.add_argument("path", help="入力ファイル（.jsonl / .jsonl.gz / .parquet / .arrow）")
+    import_parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE, help="1回に挿入する行数")
+
+    args = parser.parse_args()
+    init_db()
+    if args.command == "export":
+        count = export_messages(args.path, args.user_id, args.date_from, args.date_to, args.batch_size)
+        print(f"{count}件のメッセージを書き出しました。")
+    else:
+        count = import_messages(args.path, args.batch_size)
+        print(f"{count}件のメッセージを取り込みました。")
+
+
+if __name__ == "__main__":
+    main()
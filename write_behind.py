@@ -0,0 +1,239 @@
+# write_behind.py
+import atexit
+import glob
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from time import sleep
+
+try:
+    import fcntl
+except ImportError:
+    # Windowsではファイルロックを使わない（同じジャーナルを複数のプロセスで使わないこと）
+    fcntl = None
+
+from database import save_turns, current_time_jst
+from config import (
+    WRITE_BEHIND_JOURNAL, WRITE_BEHIND_MAX_PENDING, WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_FLUSH_INTERVAL,
+    WRITE_BEHIND_PUT_TIMEOUT, WRITE_BEHIND_RETRY_BASE_DELAY, WRITE_BEHIND_RETRY_MAX_DELAY,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _encode_turn(turn):
+    return {**turn, "timestamp": turn["timestamp"].isoformat() if turn.get("timestamp") else None}
+
+
+def _decode_turn(record):
+    return {**record, "timestamp": datetime.fromisoformat(record["timestamp"]) if record.get("timestamp") else None}
+
+
+def _try_lock(file):
+    """ファイルの排他ロックを待たずに取得する。他のプロセスが持っている場合はFalseを返す"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+@contextmanager
+def _locked(path):
+    # ジャーナルの作成と回収を、同じプレフィックスを使うプロセスの間で順番に行う
+    with open(path, "a") as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+class WriteBehindQueue:
+    """会話の往復をジャーナルに記録してから、専用の書き込みスレッドでまとめてコミットするキュー
+
+    submitはジャーナルへの追記（fsync）が終わった時点で返るため、コミット前にプロセスが
+    落ちても次回起動時にジャーナルから再送される。キューが満杯のときはsubmitが待たされる。
+    ジャーナルはプロセスごとのファイル（journal_path.<pid>）で、使っている間はロックしておく。
+    起動時には、ロックされていない（書いたプロセスが終了した）ジャーナルだけを回収する。
+    コミットに失敗した場合は、書き込みスレッドが指数バックオフで再試行する。
+    """
+
+    def __init__(self, journal_path=WRITE_BEHIND_JOURNAL, max_pending=WRITE_BEHIND_MAX_PENDING,
+                 batch_size=WRITE_BEHIND_BATCH_SIZE, flush_interval=WRITE_BEHIND_FLUSH_INTERVAL,
+                 put_timeout=WRITE_BEHIND_PUT_TIMEOUT):
+        self.journal_prefix = journal_path
+        self.journal_path = f"{journal_path}.{os.getpid()}"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        # 会話IDごとの未コミットの往復（同じセッションからの読み込み用）
+        self._pending = {}
+        self._stopped = False
+        self._journal = None
+        self._writer = None
+
+    def start(self):
+        """ジャーナルに残っている往復を再送してから書き込みスレッドを起動する"""
+        with self._lock:
+            if self._writer is not None:
+                return
+            with _locked(f"{self.journal_prefix}.lock"):
+                self.recover()
+                self._journal = open(self.journal_path, "a", encoding="utf-8")
+                _try_lock(self._journal)
+            self._writer = threading.Thread(target=self._write_loop, name="write-behind", daemon=True)
+            self._writer.start()
+
+    def recover(self):
+        """終了したプロセスがコミットしなかった往復をジャーナルから読み込んで保存する"""
+        count = 0
+        # 以前の版が使っていたプロセス共通のジャーナルも回収する
+        paths = [self.journal_prefix] + glob.glob(glob.escape(self.journal_prefix) + ".[0-9]*")
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding="utf-8") as journal:
+                if not _try_lock(journal):
+                    # 動いている他のプロセスのジャーナル
+                    continue
+                count += self._recover_journal(journal)
+                os.remove(path)
+        return count
+
+    def _recover_journal(self, journal):
+        turns = {}
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 書き込み途中で落ちた最後の行は確定していないため無視する
+                continue
+            if record["op"] == "turn":
+                turns[record["turn"]["turn_id"]] = _decode_turn(record["turn"])
+            elif record["op"] == "commit":
+                for turn_id in record["turn_ids"]:
+                    turns.pop(turn_id, None)
+        if turns:
+            # turn_idで重複を除くため、コミット済みの往復が含まれていても二重に保存されない
+            save_turns(list(turns.values()))
+            logger.info("ジャーナルから%d件の往復を保存しました", len(turns))
+        return len(turns)
+
+    def submit(self, conversation_id, user_id, user_message, assistant_messages, timestamp=None):
+        """往復をジャーナルに記録してキューに積み、保存される往復を返す"""
+        turn = {
+            "turn_id": uuid.uuid4().hex,
+            "conversation_id": conversation_id,
+            "user_id": user_id,
+            "user_message": user_message,
+            "assistant_messages": assistant_messages,
+            "timestamp": timestamp or current_time_jst(),
+        }
+        self.start()
+        with self._lock:
+            self._append_journal({"op": "turn", "turn": _encode_turn(turn)})
+            self._pending.setdefault(conversation_id, []).append(turn)
+        try:
+            self._queue.put(turn, timeout=self.put_timeout)
+        except queue.Full:
+            # 書き込みが追いつかない場合は呼び出し元で直接保存する
+            logger.warning("write-behindキューが満杯のため同期的に保存します")
+            self._commit([turn])
+        return turn
+
+    def pending_turns(self, conversation_id):
+        """指定された会話のうち、まだコミットされていない往復を返す"""
+        with self._lock:
+            return list(self._pending.get(conversation_id, []))
+
+    def _append_journal(self, record):
+        self._journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _write_loop(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if self._stopped:
+                    return
+                continue
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit_with_retry(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _commit_with_retry(self, turns):
+        # database is lockedなどの一時的な失敗は、コミットできるまで指数バックオフで再試行する
+        attempt = 0
+        while True:
+            try:
+                self._commit(turns)
+                return
+            except Exception:
+                if self._stopped:
+                    # ジャーナルには残っているため、次回起動時に再送される
+                    logger.exception("write-behindの書き込みに失敗しました")
+                    return
+                delay = min(WRITE_BEHIND_RETRY_MAX_DELAY, WRITE_BEHIND_RETRY_BASE_DELAY * 2 ** attempt)
+                logger.warning("write-behindの書き込みに失敗したため%.1f秒後に再試行します", delay, exc_info=True)
+                sleep(random.uniform(delay / 2, delay))
+                attempt += 1
+
+    def _commit(self, turns):
+        save_turns(turns)
+        with self._lock:
+            for turn in turns:
+                pending = self._pending.get(turn["conversation_id"], [])
+                if turn in pending:
+                    pending.remove(turn)
+                if not pending:
+                    self._pending.pop(turn["conversation_id"], None)
+            if self._pending:
+                self._append_journal({"op": "commit", "turn_ids": [turn["turn_id"] for turn in turns]})
+            else:
+                # 未コミットの往復がなくなったらジャーナルを空にする
+                self._journal.seek(0)
+                self._journal.truncate()
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+
+    def flush(self):
+        """キューに積まれた往復がすべてコミットされるまで待つ"""
+        if self._writer is not None:
+            self._queue.join()
+
+    def shutdown(self):
+        """残りの往復をコミットしてから書き込みスレッドを停止する"""
+        if self._writer is None or self._journal.closed:
+            return
+        # 停止中は再試行せず、コミットできなかった往復はジャーナルに残して次回起動時に再送する
+        self._stopped = True
+        self.flush()
+        self._writer.join()
+        with self._lock:
+            empty = not self._pending
+        self._journal.close()
+        if empty:
+            os.remove(self.journal_path)
+
+
+write_queue = WriteBehindQueue()
+atexit.register(write_queue.shutdown)